@@ -3,5 +3,7 @@
 
 #define DEFAULT_STRING_LENGTH 10000
 #define VERSION "0.1"
+// Time to wait for the db lock held by concurrent blissify runs, in ms
+#define BUSY_TIMEOUT 60000
 
 #endif  // CONSTANTS_H
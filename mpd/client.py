@@ -9,6 +9,10 @@ and MPD_PORT scheme described in `mpc` man.
 You can pass an integer argument to the script to change the length of the
 generated playlist (default is to add 20 songs).
 """
+import time
+# Taken before the other imports, to report the startup time of the script
+_STARTED = time.perf_counter()
+
 import argparse
 import logging
 import math
@@ -21,32 +25,47 @@ import enum
 import mpd
 import random
 
-class PersistentMPDClient(mpd.MPDClient):
+import instrument
+import knn
+import normalisation
+import planner
+import replica
+import schema
+import snapshot
+
+class PersistentMPDClient:
     """
     From
     https://github.com/schamp/PersistentMPDClient/blob/master/PersistentMPDClient.py
+
+    Commands are forwarded to an MPDClient, and only wrapped on their first
+    use, not to spend a `commands` round-trip and the wrapping of all the
+    MPD commands at startup.
     """
+    # client functions not to intercept
+    command_blacklist = {'ping', 'connect', 'disconnect', 'fileno'}
+
     def __init__(self, socket=None, host=None, port=None):
-        super().__init__()
+        self.client = mpd.MPDClient()
         self.socket = socket
         self.host = host
         self.port = port
+        self.last_command = 0
 
         self.do_connect()
-        # get list of available commands from client
-        self.command_list = self.commands()
 
-        # commands not to intercept
-        self.command_blacklist = ['ping']
-
-        # wrap all valid MPDClient functions
-        # in a ping-connection-retry wrapper
-        for cmd in self.command_list:
-            if cmd not in self.command_blacklist:
-                if hasattr(super(PersistentMPDClient, self), cmd):
-                    super_fun = super(PersistentMPDClient, self).__getattribute__(cmd)
-                    new_fun = self.try_cmd(super_fun)
-                    setattr(self, cmd, new_fun)
+    # only called for the attributes not set on the instance, i.e. the first
+    # time a command is used: wrap the MPDClient function in a
+    # ping-connection-retry wrapper, and keep it for the next uses
+    def __getattr__(self, cmd):
+        if cmd == 'client':
+            raise AttributeError(cmd)
+        fun = getattr(self.client, cmd)
+        if cmd in self.command_blacklist or not callable(fun):
+            return fun
+        new_fun = self.try_cmd(fun, cmd)
+        setattr(self, cmd, new_fun)
+        return new_fun
 
     # create a wrapper for a function (such as an MPDClient
     # member function) that will verify a connection (and
@@ -56,17 +75,28 @@ class PersistentMPDClient(mpd.MPDClient):
     # we ping first because we don't want to retry the same
     # function if there's a failure, we want to use the noop
     # to check connectivity
-    def try_cmd(self, cmd_fun):
+    # the connection is only checked if it has been idle for
+    # more than _PING_INTERVAL, to save a round-trip per command
+    def try_cmd(self, cmd_fun, cmd):
+        phase = "mpd_%s" % (cmd,)
+
         def fun(*pargs, **kwargs):
-            try:
-                self.ping()
-            except (mpd.ConnectionError, OSError):
-                self.do_connect()
-            return cmd_fun(*pargs, **kwargs)
+            instrument.count("mpd_commands")
+            if time.monotonic() - self.last_command > _PING_INTERVAL:
+                instrument.count("mpd_commands")
+                try:
+                    self.ping()
+                except (mpd.ConnectionError, OSError):
+                    self.do_connect()
+            with instrument.timer(phase):
+                result = cmd_fun(*pargs, **kwargs)
+            self.last_command = time.monotonic()
+            return result
         return fun
 
     # needs a name that does not collide with parent connect() function
     def do_connect(self):
+        instrument.count("mpd_connections")
         try:
             try:
                 self.disconnect()
@@ -88,6 +118,8 @@ class PersistentMPDClient(mpd.MPDClient):
                 self.connect(self.socket, None)
             else:
                 self.connect(self.host, self.port)
+            # no need to check a new connection
+            self.last_command = time.monotonic()
         except socket.error:
             print("Connection refused.")
 
@@ -95,12 +127,35 @@ class PersistentMPDClient(mpd.MPDClient):
 logging.basicConfig(level=logging.INFO)
 
 _QUEUE_LENGTH = 20
+# Seconds of inactivity after which the MPD connection is checked
+_PING_INTERVAL = 10
 
 if "XDG_DATA_HOME" in os.environ:
     _BLISSIFY_DATA_HOME = os.path.expandvars("$XDG_DATA_HOME/blissify")
 else:
     _BLISSIFY_DATA_HOME = os.path.expanduser("~/.local/share/blissify")
 
+_SONG_QUERY = schema.query(
+    "SELECT id, tempo, amplitude, frequency, attack, filename, album FROM song_features WHERE filename=?",
+    ["songs"])
+_ALBUM_SONGS_QUERY = schema.query(
+    "SELECT id, tempo, amplitude, frequency, attack, filename, album FROM song_features WHERE album=?",
+    ["songs"])
+_ALL_SONGS_QUERY = schema.query(
+    "SELECT id, tempo, amplitude, frequency, attack, filename FROM song_features")
+_NEIGHBOURS_QUERY = schema.query(
+    "SELECT song_features.id, tempo, amplitude, frequency, attack, filename, neighbours.distance FROM neighbours JOIN song_features ON song_features.id=neighbours.neighbour WHERE neighbours.song=? ORDER BY neighbours.distance",
+    ["neighbours", "songs", "features"])
+_CENTROIDS_QUERY = schema.query(
+    "SELECT album, tempo, amplitude, frequency, attack, (SELECT filename FROM songs WHERE songs.album=album_centroids.album ORDER BY id LIMIT 1) AS filename FROM album_centroids",
+    ["songs"])
+_NEIGHBOUR_ALBUMS_QUERY = schema.query(
+    "SELECT DISTINCT songs.album FROM neighbours JOIN songs ON songs.id=neighbours.neighbour WHERE neighbours.song IN (SELECT id FROM songs WHERE album=?)",
+    ["neighbours", "songs"])
+_ALBUMS_QUERY = schema.query("SELECT DISTINCT album FROM songs")
+_SONG_ID_QUERY = schema.query("SELECT id FROM songs WHERE filename=?",
+                              ["songs"])
+
 
 def distance(x, y):
     """
@@ -119,6 +174,13 @@ def distance(x, y):
     )
 
 
+def features(x):
+    """
+    Returns: The features tuple of a song dict.
+    """
+    return (x["tempo"], x["amplitude"], x["frequency"], x["attack"])
+
+
 def mean_song(X):
     """
     Compute a "mean" song for a given iterable of song dicts.
@@ -159,7 +221,17 @@ def distance_sets(X, Y):
     return distance(mean_song(X), mean_song(Y))
 
 
-def _init():
+def _connect_replica():
+    """
+    Returns: A read-only SQLite connection to the replica of the db, which
+    is up to date already.
+    """
+    replica_path = os.path.join(_BLISSIFY_DATA_HOME, "replica.sqlite3")
+    logging.debug("Using DB replica path: %s." % (replica_path,))
+    return replica.connect(replica_path)
+
+
+def _init(use_replica=False):
     # Get MPD connection settings
     try:
         mpd_host = os.environ["MPD_HOST"]
@@ -176,15 +248,29 @@ def _init():
         mpd_port = 6600
 
     # Connect to MPD
-    client = PersistentMPDClient(host=mpd_host, port=mpd_port)
+    with instrument.timer("mpd_connect"):
+        client = PersistentMPDClient(host=mpd_host, port=mpd_port)
     if mpd_password is not None:
         client.password(mpd_password)
     # Connect to db
-    db_path = os.path.join(_BLISSIFY_DATA_HOME, "db.sqlite3")
-    logging.debug("Using DB path: %s." % (db_path,))
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    conn.execute('pragma foreign_keys=ON')
+    with instrument.timer("db_init"):
+        if use_replica:
+            try:
+                conn = _connect_replica()
+            except FileNotFoundError as e:
+                logging.error("%s Run server.py or build_cache.py with --replica first." %
+                              (e,))
+                client.close()
+                client.disconnect()
+                sys.exit(1)
+        else:
+            db_path = os.path.join(_BLISSIFY_DATA_HOME, "db.sqlite3")
+            logging.debug("Using DB path: %s." % (db_path,))
+            conn = sqlite3.connect(db_path)
+            conn.row_factory = sqlite3.Row
+            conn.execute('pragma foreign_keys=ON')
+            schema.migrate(conn)
+            normalisation.refresh(conn)
     cur = conn.cursor()
 
     # Ensure random is not enabled
@@ -193,20 +279,23 @@ def _init():
         logging.warning("Random mode is enabled. Are you sure you want it?")
 
     # Take the last song from current playlist and iterate from it
-    playlist = client.playlist()
+    playlist = [x.replace("file: ", "").rstrip() for x in client.playlist()]
     if len(playlist) > 0:
-        current_song = playlist[-1].replace("file: ", "").rstrip()
+        current_song = playlist[-1]
     # If current playlist is empty
     else:
         # Add a random song to start with TODO add a random album
         all_songs = [x["file"] for x in client.listall() if "file" in x]
         current_song = random.choice(all_songs)
         client.add(current_song)
+        playlist.append(current_song)
+    # Keep track of queued songs locally, not to query MPD for each candidate
+    queued = set(playlist)
 
     logging.info("Currently played song is %s." % (current_song,))
 
     # Get current song coordinates
-    cur.execute("SELECT id, tempo, amplitude, frequency, attack, filename, album FROM songs WHERE filename=?", (current_song,))
+    cur.execute(_SONG_QUERY, (current_song,))
     current_song_coords = cur.fetchone()
     if current_song_coords is None:
         logging.error("Current song %s is not in db. You should update the db." %
@@ -215,95 +304,489 @@ def _init():
         client.disconnect()
         sys.exit(1)
 
-    return client, conn, cur, current_song_coords
+    return client, conn, cur, current_song_coords, queued
 
 
-def main_album(queue_length, option_best=True):
-    client, conn, cur, current_song_coords = _init()
-
-    # Get 'queue_length' random albums
-    for i in range(queue_length):
-        # No cache management
-        # Get all songs from the current album
-        distance_array = []
+def _record_startup():
+    """
+    Record the startup time of the script, from its first import to the end
+    of its first search (loading the songs and building the search index
+    included), on the first call.
+    """
+    global _STARTED
+    if _STARTED is not None:
+        instrument.record("startup", time.perf_counter() - _STARTED)
+        _STARTED = None
 
-        # Get album name and all of this album's songs coordinates
-        album_name = current_song_coords["album"]
-        cur.execute("SELECT id, tempo, amplitude, frequency, attack, filename, album FROM songs WHERE album=?", (album_name,))
-        target_album_set = cur.fetchall()
 
-        # Get all albums
-        cur.execute("SELECT DISTINCT album FROM songs")
-        albums = cur.fetchall();
+def _album_distances(queued, cur, target_album_set, albums):
+    """
+    Compute the distance between the current album and some other albums.
 
-        # Compute the distance between current album and all other albums
-        for tmp_album in albums:
-            # Get all songs in the album
-            cur.execute("SELECT id, tempo, amplitude, frequency, attack, filename, album FROM songs WHERE album=?", (tmp_album["album"],))
+    Params:
+        - queued: The set of filenames in the MPD playlist.
+        - cur: A db cursor.
+        - target_album_set: The songs of the current album.
+        - albums: The albums to compare with.
+    Returns: A list of {'Distance', 'Album'} dicts, sorted by ascending
+    distance.
+    """
+    distance_array = []
+    for tmp_album in albums:
+        # Get all songs in the album
+        with instrument.timer("db_read"):
+            cur.execute(_ALBUM_SONGS_QUERY, (tmp_album["album"],))
             tmp_songs = cur.fetchall()
-            # Don't compute distance for the current album and albums already in the playlist
-            if(tmp_album["album"] == target_album_set[0]["album"] or
-               ("file: %s" % (tmp_songs[0]["filename"],)) in client.playlist()):
-                # Skip current song and already processed songs
-                logging.debug("Skipping %s." % (tmp_album["album"]))
-                continue
-           
-            tmp_distance = distance_sets(tmp_songs, target_album_set)
-            distance_array.append({'Distance': tmp_distance, 'Album': tmp_songs})
-            logging.debug("Distance between %s and %s is %f." %
-                (target_album_set[0]["album"],
-                tmp_album["album"], tmp_distance))
-
-        # Ascending sort by distance (the lower the closer)
-        distance_array.sort(key=lambda x: x["Distance"])
-
-        # Chose between best album and one of the top 10 at random
-        indice = 0 if option_best else random.randrange(10)
-        
-        logging.info("Closest album found is \"%s\". Distance is %f." %
-            (distance_array[indice]["Album"][0]["album"], distance_array[indice]["Distance"]))
+        instrument.count("albums_scanned")
+        instrument.count("songs_scanned", len(tmp_songs))
+        if not tmp_songs:
+            # Features of new songs are not normalised yet
+            continue
+        # Don't compute distance for the current album and albums already in the playlist
+        if(tmp_album["album"] == target_album_set[0]["album"] or
+           tmp_songs[0]["filename"] in queued):
+            # Skip current song and already processed songs
+            continue
 
-        for song in distance_array[indice]["Album"]:
-            client.add(song["filename"])
+        with instrument.timer("distances"):
+            tmp_distance = distance_sets(tmp_songs, target_album_set)
+        distance_array.append({'Distance': tmp_distance, 'Album': tmp_songs})
 
-    conn.close()
-    client.close()
-    client.disconnect()
+    # Ascending sort by distance (the lower the closer)
+    distance_array.sort(key=lambda x: x["Distance"])
+    return distance_array
 
 
-def main_single(queue_length, option_best=True):
-    client, conn, cur, current_song_coords = _init()
+def _centroid_distances(queued, cur, tree, albums, target_album, count):
+    """
+    Get the nearest albums of the current album from a nearest neighbours
+    index over the albums centroids.
 
-    # Get 'queue_length' random songs
-    for i in range(queue_length):
-        distance_array = []
+    Params:
+        - queued: The set of filenames in the MPD playlist.
+        - cur: A db cursor.
+        - tree: A KD-tree (or GridIndex) over the features of albums.
+        - albums: The list of all album centroids.
+        - target_album: The centroid of the current album.
+        - count: Number of albums to return.
+    Returns: A list of {'Distance', 'Album'} dicts, sorted by ascending
+    distance.
+    """
+    def skip(index):
+        # Skip current album and albums already in the playlist
+        return (albums[index]["album"] == target_album["album"] or
+                albums[index]["filename"] in queued)
+
+    distance_array = []
+    with instrument.timer("index_search"):
+        nearest = tree.nearest(features(target_album), count, skip)
+    for tmp_distance, index in nearest:
+        cur.execute(_ALBUM_SONGS_QUERY, (albums[index]["album"],))
+        distance_array.append({'Distance': tmp_distance,
+                               'Album': cur.fetchall()})
+    return distance_array
+
+
+def _song_distances(queued, cur, current_song_coords):
+    """
+    Compute the distance between the current song and all the other songs.
 
-        # Get all other songs coordinates and iterate on them
-        cur.execute("SELECT id, tempo, amplitude, frequency, attack, filename FROM songs")
-        for tmp_song_data in cur.fetchall():
+    Returns: A list of {'Distance', 'Song'} dicts, sorted by ascending
+    distance.
+    """
+    distance_array = []
+
+    # Get all other songs coordinates and iterate on them
+    with instrument.timer("db_read"):
+        cur.execute(_ALL_SONGS_QUERY)
+        all_songs = cur.fetchall()
+    instrument.count("songs_scanned", len(all_songs))
+    with instrument.timer("distances"):
+        for tmp_song_data in all_songs:
             # Skip current song and already processed songs
             if(tmp_song_data["filename"] == current_song_coords["filename"] or
-               ("file: %s" % (tmp_song_data["filename"],)) in client.playlist()):
-                logging.debug("Skipping %s." % (tmp_song_data["filename"]))
+               tmp_song_data["filename"] in queued):
                 continue
             # Compute distance between current song and songs in the loop
             tmp_distance = distance(tmp_song_data, current_song_coords)
-            distance_array.append({'Distance': tmp_distance, 'Song': tmp_song_data})
-            logging.debug("Distance between %s and %s is %f." %
-                (current_song_coords["filename"],
-                tmp_song_data["filename"], tmp_distance))
+            distance_array.append({'Distance': tmp_distance,
+                                   'Song': tmp_song_data})
 
         # Ascending sort by distance (the lower the closer)
         distance_array.sort(key=lambda x: x['Distance'])
+    return distance_array
+
+
+def _nearest_index(points, engine, probes=knn._PROBES):
+    """
+    Build the nearest neighbours index of a search engine.
+
+    Params:
+        - points: The list of features tuples to index.
+        - engine: Either "kdtree" (exact) or "ann" (approximate).
+        - probes: Probes of the approximate engine.
+    Returns: A KDTree or a GridIndex.
+    """
+    with instrument.timer("index_build"):
+        if engine == "ann":
+            return knn.GridIndex(points, probes)
+        return knn.KDTree(points)
+
+
+def _tree_distances(queued, tree, all_songs, current_song_coords, count):
+    """
+    Get the nearest songs of the current song from a nearest neighbours index
+    over all the songs.
+
+    Params:
+        - queued: The set of filenames in the MPD playlist.
+        - tree: A KD-tree (or GridIndex) over the features of all_songs.
+        - all_songs: The snapshot of all songs.
+        - current_song_coords: The current song.
+        - count: Number of songs to return.
+    Returns: A list of {'Distance', 'Song'} dicts, sorted by ascending
+    distance.
+    """
+    def skip(index):
+        # Skip current song and already processed songs
+        filename = all_songs.filename(index)
+        return (filename == current_song_coords["filename"] or
+                filename in queued)
+
+    with instrument.timer("index_search"):
+        nearest = tree.nearest(features(current_song_coords), count, skip)
+    return [{'Distance': tmp_distance, 'Song': all_songs[index]}
+            for tmp_distance, index in nearest]
+
 
-        # Chose between best album and one of the top 10 at random
-        indice = 0 if option_best else random.randrange(10)
+def _neighbour_distances(queued, cur, current_song_coords):
+    """
+    Get the cached nearest neighbours of the current song.
+
+    Returns: A list of {'Distance', 'Song'} dicts, sorted by ascending
+    distance.
+    """
+    distance_array = []
+    with instrument.timer("db_read"):
+        cur.execute(_NEIGHBOURS_QUERY, (current_song_coords["id"],))
+        neighbours = cur.fetchall()
+    instrument.count("neighbours_read", len(neighbours))
+    for tmp_song_data in neighbours:
+        # Skip already processed songs
+        if tmp_song_data["filename"] in queued:
+            continue
+        distance_array.append({'Distance': tmp_song_data["distance"],
+                               'Song': tmp_song_data})
+    return distance_array
+
+
+class SongSearch:
+    """
+    Search of the closest songs of a song, for song-based mixes.
+    """
+    def __init__(self, conn, engine="kdtree", probes=knn._PROBES):
+        self.cur = conn.cursor()
+        self.engine = engine
+        self.probes = probes
+        self.use_neighbours = schema.has_table(conn, "neighbours")
+        if engine != "scan":
+            # Map the songs from their snapshot, the index being only built
+            # on the first search not served by the cached neighbours
+            with instrument.timer("snapshot_load"):
+                self.all_songs = snapshot.load(conn)
+            self.tree = None
+
+    def closest(self, queued, current_song_coords, count):
+        """
+        Find the closest songs of a song.
+
+        Params:
+            - queued: The set of filenames in the MPD playlist.
+            - current_song_coords: The current song.
+            - count: Number of songs needed.
+        Returns: A list of {'Distance', 'Song'} dicts, sorted by ascending
+        distance.
+        """
+        distance_array = []
+        if self.use_neighbours:
+            distance_array = _neighbour_distances(queued, self.cur,
+                                                  current_song_coords)
+        if len(distance_array) >= count:
+            return distance_array
+        if self.engine != "scan":
+            # Not enough cached neighbours, search all songs
+            if self.tree is None:
+                self.tree = _nearest_index(self.all_songs.points(),
+                                           self.engine, self.probes)
+            return _tree_distances(queued, self.tree, self.all_songs,
+                                   current_song_coords, count)
+        # Not enough cached neighbours, iterate on all songs
+        return _song_distances(queued, self.cur, current_song_coords)
+
+
+class AlbumSearch:
+    """
+    Search of the closest albums of an album, for album-based mixes.
+    """
+    def __init__(self, conn, engine="kdtree", probes=knn._PROBES):
+        self.cur = conn.cursor()
+        self.engine = engine
+        self.use_neighbours = schema.has_table(conn, "neighbours")
+        if engine != "scan":
+            # Build the index over albums centroids once for all the searches
+            with instrument.timer("db_read"):
+                self.cur.execute(_CENTROIDS_QUERY)
+                centroids = self.cur.fetchall()
+            # Centroids of normalised features are normalised centroids
+            stats = normalisation.load_stats(conn)
+            self.albums = []
+            for album in centroids:
+                centroid = dict(zip(normalisation.FEATURES,
+                                    normalisation.normalise(album, stats)))
+                centroid["album"] = album["album"]
+                centroid["filename"] = album["filename"]
+                self.albums.append(centroid)
+            self.tree = _nearest_index([features(album)
+                                        for album in self.albums],
+                                       engine, probes)
+            self.album_index = {album["album"]: index
+                                for index, album in enumerate(self.albums)}
+
+    def closest(self, queued, album_name, count):
+        """
+        Find the closest albums of an album.
+
+        Params:
+            - queued: The set of filenames in the MPD playlist.
+            - album_name: The current album.
+            - count: Number of albums needed.
+        Returns: A list of {'Distance', 'Album'} dicts, sorted by ascending
+        distance.
+        """
+        if self.engine != "scan" and album_name in self.album_index:
+            target_album = self.albums[self.album_index[album_name]]
+            return _centroid_distances(queued, self.cur, self.tree,
+                                       self.albums, target_album, count)
+
+        # Get all of this album's songs coordinates
+        self.cur.execute(_ALBUM_SONGS_QUERY, (album_name,))
+        target_album_set = self.cur.fetchall()
 
-        current_song_coords = distance_array[indice]['Song']
+        distance_array = []
+        if self.use_neighbours:
+            # Only consider albums of the cached neighbours of this album's songs
+            self.cur.execute(_NEIGHBOUR_ALBUMS_QUERY, (album_name,))
+            distance_array = _album_distances(queued, self.cur,
+                                              target_album_set,
+                                              self.cur.fetchall())
+        if len(distance_array) < count:
+            # Get all albums
+            self.cur.execute(_ALBUMS_QUERY)
+            distance_array = _album_distances(queued, self.cur,
+                                              target_album_set,
+                                              self.cur.fetchall())
+        return distance_array
+
+
+def _add_album(client, search, queued, album_name, option_best=True):
+    """
+    Add the songs of the closest album of an album to the MPD playlist.
 
-        client.add(current_song_coords["filename"])
+    Returns: The list of added songs, empty if no album is left.
+    """
+    # Chose between best album and one of the top 10 at random
+    indice = 0 if option_best else random.randrange(10)
+    distance_array = search.closest(queued, album_name, indice + 1)
+    _record_startup()
+    if len(distance_array) == 0:
+        logging.warning("No album left to add.")
+        return []
+    indice = min(indice, len(distance_array) - 1)
+
+    logging.info("Closest album found is \"%s\". Distance is %f." %
+        (distance_array[indice]["Album"][0]["album"], distance_array[indice]["Distance"]))
+
+    for song in distance_array[indice]["Album"]:
+        client.add(song["filename"])
+        queued.add(song["filename"])
+    instrument.count("albums_added")
+    instrument.count("songs_added", len(distance_array[indice]["Album"]))
+    return distance_array[indice]["Album"]
+
+
+def _add_song(client, search, queued, current_song_coords, option_best=True):
+    """
+    Add the closest song of a song to the MPD playlist.
+
+    Returns: The added song, or None if no song is left.
+    """
+    # Chose between best song and one of the top 10 at random
+    indice = 0 if option_best else random.randrange(10)
+    distance_array = search.closest(queued, current_song_coords, indice + 1)
+    _record_startup()
+    if len(distance_array) == 0:
+        logging.warning("No song left to add.")
+        return None
+    indice = min(indice, len(distance_array) - 1)
+
+    song = distance_array[indice]['Song']
+    client.add(song["filename"])
+    queued.add(song["filename"])
+    instrument.count("songs_added")
+    logging.info("Found a close song: %s. Distance is %f." %
+        (song["filename"], distance_array[0]['Distance']))
+    return song
+
+
+def _add_plan(client, conn, queued, current_song_coords, count,
+              beam_width=planner._BEAM_WIDTH):
+    """
+    Plan a mix of songs from a song, and add it to the MPD playlist.
+
+    Returns: The list of added songs, empty if no song is left.
+    """
+    with instrument.timer("snapshot_load"):
+        songs = snapshot.load(conn)
+    start = songs.index(current_song_coords["id"])
+    excluded = []
+    with instrument.timer("db_read"):
+        for filename in queued:
+            row = conn.execute(_SONG_ID_QUERY, (filename,)).fetchone()
+            if row is not None and songs.index(row["id"]) is not None:
+                excluded.append(songs.index(row["id"]))
+    with instrument.timer("plan"):
+        mix = planner.plan(songs, start, count, beam_width, excluded)
+    _record_startup()
+    added = []
+    for tmp_distance, index in mix:
+        song = songs[index]
+        client.add(song["filename"])
+        queued.add(song["filename"])
+        instrument.count("songs_added")
         logging.info("Found a close song: %s. Distance is %f." %
-            (current_song_coords["filename"], distance_array[0]['Distance']))
+            (song["filename"], tmp_distance))
+        added.append(song)
+    if len(added) < count:
+        logging.warning("No song left to add.")
+    return added
+
+
+def main_album(queue_length, option_best=True, engine="kdtree",
+               probes=knn._PROBES, use_replica=False):
+    client, conn, cur, current_song_coords, queued = _init(use_replica)
+    search = AlbumSearch(conn, engine, probes)
+
+    # Get 'queue_length' random albums
+    for i in range(queue_length):
+        if not _add_album(client, search, queued,
+                          current_song_coords["album"], option_best):
+            break
+
+    conn.close()
+    client.close()
+    client.disconnect()
+
+
+def main_single(queue_length, option_best=True, engine="kdtree",
+                beam_width=None, probes=knn._PROBES, use_replica=False):
+    client, conn, cur, current_song_coords, queued = _init(use_replica)
+    if beam_width is not None:
+        # Plan the whole mix at once
+        _add_plan(client, conn, queued, current_song_coords, queue_length,
+                  beam_width)
+    else:
+        search = SongSearch(conn, engine, probes)
+
+        # Get 'queue_length' random songs
+        for i in range(queue_length):
+            current_song_coords = _add_song(client, search, queued,
+                                            current_song_coords, option_best)
+            if current_song_coords is None:
+                break
+
+    conn.close()
+    client.close()
+    client.disconnect()
+
+
+def _db_mtime(db_path):
+    """
+    Returns: The modification times of the db files, to detect changes.
+    """
+    mtimes = []
+    for path in [db_path, "%s-wal" % (db_path,)]:
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            mtimes.append(None)
+    return tuple(mtimes)
+
+
+def main_daemon(queue_length, option_best=True, engine="kdtree",
+                album_based=False, beam_width=None, probes=knn._PROBES,
+                use_replica=False):
+    """
+    Keep 'queue_length' songs queued after the current one, following MPD
+    IDLE signals. Songs and search indexes are kept in memory and only
+    reloaded when the db (or its replica) changes.
+    """
+    client, conn, cur, current_song_coords, queued = _init(use_replica)
+    db_path = os.path.join(_BLISSIFY_DATA_HOME,
+                           "replica.sqlite3" if use_replica else "db.sqlite3")
+    db_mtime = _db_mtime(db_path)
+    search_class = AlbumSearch if album_based else SongSearch
+    search = search_class(conn, engine, probes)
+
+    while True:
+        if _db_mtime(db_path) != db_mtime:
+            logging.info("DB has changed, reloading songs.")
+            if use_replica:
+                # The connection keeps reading the replica it opened
+                conn.close()
+                conn = _connect_replica()
+                cur = conn.cursor()
+            else:
+                schema.migrate(conn)
+                normalisation.refresh(conn)
+            search = search_class(conn, engine, probes)
+            db_mtime = _db_mtime(db_path)
+
+        # Top up the queue
+        status = client.status()
+        upcoming = (int(status["playlistlength"]) -
+                    int(status.get("song", -1)) - 1)
+        while current_song_coords is not None and upcoming < queue_length:
+            if album_based:
+                added = _add_album(client, search, queued,
+                                   current_song_coords["album"], option_best)
+            elif beam_width is not None:
+                added = _add_plan(client, conn, queued, current_song_coords,
+                                  queue_length - upcoming, beam_width)
+            else:
+                added = _add_song(client, search, queued,
+                                  current_song_coords, option_best)
+                added = [added] if added is not None else []
+            if not added:
+                break
+            upcoming += len(added)
+            current_song_coords = added[-1]
+
+        try:
+            client.idle("playlist", "player")
+        except KeyboardInterrupt:
+            break
+
+        # Playlist may have been edited by another client
+        playlist = [x.replace("file: ", "").rstrip() for x in client.playlist()]
+        queued = set(playlist)
+        if len(playlist) == 0:
+            current_song_coords = None
+            continue
+        cur.execute(_SONG_QUERY, (playlist[-1],))
+        current_song_coords = cur.fetchone()
+        if current_song_coords is None:
+            logging.warning("Last song %s is not in db. You should update the db." %
+                            (playlist[-1],))
 
     conn.close()
     client.close()
@@ -320,15 +803,40 @@ if __name__ == "__main__":
         action="store_true", default=False)
     group.add_argument("--album-based", help="Make a playlist based on whole albums.",
         action="store_true", default=False)
+    parser.add_argument("--engine", help="Nearest songs (or albums) search engine (ann is approximate, for very large libraries).",
+        choices=["kdtree", "ann", "scan"], default="kdtree")
+    parser.add_argument("--probes", help="Rings of cells searched by the ann engine once enough candidates were found (more is slower, with a better recall).",
+        type=int, default=knn._PROBES)
+    parser.add_argument("--daemon", help="Keep running and keep --queue-length songs queued after the current one.",
+        action="store_true", default=False)
+    parser.add_argument("--plan", help="Plan the whole song-based mix at once, minimizing its total distance.",
+        action="store_true", default=False)
+    parser.add_argument("--beam-width", help="Number of candidate mixes kept at each step by --plan.",
+        type=int, default=planner._BEAM_WIDTH)
+    parser.add_argument("--replica", help="Only read the read-only replica of the db published by server.py or build_cache.py --replica.",
+        action="store_true", default=False)
+    parser.add_argument("--stats", help="Write a JSON summary of timers and counters to FILE ('-' for stderr) on exit.",
+        metavar="FILE")
+    parser.add_argument("--profile", help="Dump cProfile stats of the run to FILE.",
+        metavar="FILE")
 
     args = parser.parse_args()
+    instrument.enable(args.stats, args.profile)
+    if args.plan and args.album_based:
+        parser.error("--plan is only available for song-based mixes.")
+    beam_width = args.beam_width if args.plan else None
     if args.queue_length:
         queue_length = args.queue_length
     else:
         queue_length = _QUEUE_LENGTH
 
-    if args.song_based:
-        main_single(queue_length, args.best_playlist)
+    if args.daemon:
+        main_daemon(queue_length, args.best_playlist, args.engine,
+                    args.album_based, beam_width, args.probes, args.replica)
+    elif args.song_based:
+        main_single(queue_length, args.best_playlist, args.engine,
+                    beam_width, args.probes, args.replica)
     elif args.album_based:
-        main_album(queue_length, args.best_playlist)
+        main_album(queue_length, args.best_playlist, args.engine,
+                   args.probes, args.replica)
 
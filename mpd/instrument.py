@@ -0,0 +1,171 @@
+"""
+Lightweight instrumentation of the scripts, to tell where the time of a run
+goes: per-phase timers and counters (songs scanned, pairs computed, MPD
+commands, db rows written, ...), written as a JSON summary when the script
+exits, and optional cProfile dumps.
+
+Instrumentation is off unless `enable` is called (`--stats` and `--profile`
+options of the scripts). Timers and counters are then no-ops, costing a
+function call.
+
+_Note_: Phases may be nested, and timers of phases run in several threads
+(e.g. `blissify` processes in `server.py`) add up, so that timers may sum up
+to more than the wall time of the run.
+"""
+import atexit
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+# Counters and [seconds, calls] timers by name, None when disabled
+_counters = None
+_timers = None
+_start = None
+_lock = threading.Lock()
+_NULL_TIMER = contextlib.nullcontext()
+# End of an iterator timed by `timed`
+_END = object()
+
+
+class _Timer:
+    """
+    Context manager adding the time spent in a phase to its timer.
+    """
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def enabled():
+    """
+    Returns: Whether timers and counters are enabled.
+    """
+    return _counters is not None
+
+
+def count(name, value=1):
+    """
+    Increment a counter, if enabled.
+    """
+    if _counters is None:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def timer(name):
+    """
+    Time a phase, if enabled.
+
+    Returns: A context manager, adding the time spent in its block to the
+    timer of the phase.
+    """
+    if _timers is None:
+        return _NULL_TIMER
+    return _Timer(name)
+
+
+def timed(name, iterable):
+    """
+    Time the production of the items of an iterable (e.g. batches computed
+    by a generator) as a phase, if enabled. The time spent by the caller
+    between two items is not included.
+
+    Returns: An iterator over the items of iterable.
+    """
+    if _timers is None:
+        return iter(iterable)
+    return _timed(name, iter(iterable))
+
+
+def _timed(name, iterator):
+    while True:
+        with _Timer(name):
+            item = next(iterator, _END)
+        if item is _END:
+            return
+        yield item
+
+
+def record(name, seconds):
+    """
+    Add a duration measured by the caller to the timer of a phase, if
+    enabled.
+    """
+    if _timers is None:
+        return
+    with _lock:
+        timer = _timers.setdefault(name, [0.0, 0])
+        timer[0] += seconds
+        timer[1] += 1
+
+
+def summary():
+    """
+    Returns: A dict with the wall time of the run, the timers (seconds and
+    calls of each phase) and the counters.
+    """
+    with _lock:
+        return {
+            "script": os.path.basename(sys.argv[0]),
+            "wall_time": round(time.perf_counter() - _start, 6),
+            "timers": {
+                name: {"seconds": round(seconds, 6), "calls": calls}
+                for name, (seconds, calls) in sorted(_timers.items())
+            },
+            "counters": dict(sorted(_counters.items())),
+        }
+
+
+def write_summary(path):
+    """
+    Write the JSON summary of the run to a file, or to stderr if path is
+    "-".
+    """
+    if path == "-":
+        json.dump(summary(), sys.stderr, indent=2)
+        sys.stderr.write("\n")
+        return
+    with open(path, "w") as fh:
+        json.dump(summary(), fh, indent=2)
+        fh.write("\n")
+
+
+def enable(stats_path=None, profile_path=None):
+    """
+    Turn the instrumentation on, the results being written when the script
+    exits.
+
+    Params:
+        - stats_path: File receiving the JSON summary of timers and counters
+        ("-" for stderr), None not to enable them.
+        - profile_path: File receiving the cProfile stats of the run (to be
+        read with `pstats`), None not to profile it.
+    """
+    global _counters, _timers, _start
+    if stats_path is not None:
+        _counters = {}
+        _timers = {}
+        _start = time.perf_counter()
+        atexit.register(write_summary, stats_path)
+    if profile_path is not None:
+        # Only imported when profiling, not to slow down the startup
+        import cProfile
+        profiler = cProfile.Profile()
+        # Registered last to stop profiling before the summary is written
+        atexit.register(profiler.dump_stats, profile_path)
+        atexit.register(profiler.disable)
+        profiler.enable()
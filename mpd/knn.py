@@ -0,0 +1,339 @@
+"""
+Nearest neighbours search engines over songs features, used by `client.py` to
+find candidates for the next song of a mix without scanning the whole db at
+each step.
+
+Run `python3 knn.py --help` to measure the recall of the approximate engine on
+the songs of the db.
+"""
+import argparse
+import functools
+import heapq
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import sqlite3
+import time
+
+import normalisation
+import schema
+import snapshot
+
+_LEAF_SIZE = 16
+# Relative margin on pruning, so that rounding errors never prune a tie
+_PRUNING_MARGIN = 1e-9
+# Rings of cells visited by GridIndex once enough candidates were found
+_PROBES = 1
+# Default probes of GridIndex.nearest, those of the index, None meaning that
+# rings are visited until the results are exact
+_INDEX_PROBES = object()
+# Mean number of points per cell of GridIndex around the center of the
+# features space
+_CELL_POINTS = 8
+_RECALL_QUERIES = 100
+_RECALL_K = 10
+
+if "XDG_DATA_HOME" in os.environ:
+    _BLISSIFY_DATA_HOME = os.path.expandvars("$XDG_DATA_HOME/blissify")
+else:
+    _BLISSIFY_DATA_HOME = os.path.expanduser("~/.local/share/blissify")
+
+
+def features_distance(x, y):
+    """
+    Compute the cartesian distance between two features tuples, with the same
+    operations as `client.distance`.
+    """
+    return math.sqrt(
+        (x[0] - y[0])**2 +
+        (x[1] - y[1])**2 +
+        (x[2] - y[2])**2 +
+        (x[3] - y[3])**2
+    )
+
+
+class KDTree:
+    """
+    A KD-tree over features tuples.
+
+    Results are ordered by ascending distance, ties being broken by index in
+    the list of points, so that they match a stable sort of a full scan.
+    """
+    def __init__(self, points, leaf_size=_LEAF_SIZE):
+        self.points = points
+        self.leaf_size = leaf_size
+        self._root = self._build(list(range(len(points))))
+
+    def _build(self, indices):
+        """
+        Build the subtree for some points.
+
+        Returns: A (None, indices) leaf or an (axis, split, left, right) node.
+        """
+        if len(indices) <= self.leaf_size:
+            return (None, indices)
+        # Split on the axis with the largest spread
+        spreads = [
+            max(self.points[i][axis] for i in indices) -
+            min(self.points[i][axis] for i in indices)
+            for axis in range(len(self.points[indices[0]]))
+        ]
+        axis = spreads.index(max(spreads))
+        indices = sorted(indices, key=lambda i: self.points[i][axis])
+        middle = len(indices) // 2
+        return (axis, self.points[indices[middle]][axis],
+                self._build(indices[:middle]), self._build(indices[middle:]))
+
+    def nearest(self, point, k=1, skip=None):
+        """
+        Find the nearest neighbours of a point.
+
+        Params:
+            - point: A features tuple.
+            - k: Number of neighbours to return.
+            - skip: An optional function taking an index and returning
+            whether this point should be ignored.
+        Returns: A list of at most k (distance, index) tuples, sorted by
+        ascending distance.
+        """
+        # Max-heap of (-distance, -index), the worst candidate being on top
+        heap = []
+        self._search(self._root, point, k, skip, heap)
+        return sorted((-distance, -index) for distance, index in heap)
+
+    def _search(self, node, point, k, skip, heap):
+        axis = node[0]
+        if axis is None:
+            for index in node[1]:
+                distance = features_distance(point, self.points[index])
+                if len(heap) == k and (distance, index) > (-heap[0][0],
+                                                           -heap[0][1]):
+                    continue
+                if skip is not None and skip(index):
+                    continue
+                if len(heap) == k:
+                    heapq.heapreplace(heap, (-distance, -index))
+                else:
+                    heapq.heappush(heap, (-distance, -index))
+            return
+        _, split, left, right = node
+        diff = point[axis] - split
+        near, far = (left, right) if diff < 0 else (right, left)
+        self._search(near, point, k, skip, heap)
+        if (len(heap) < k or
+                abs(diff) <= -heap[0][0] * (1 + _PRUNING_MARGIN)):
+            self._search(far, point, k, skip, heap)
+
+
+@functools.lru_cache(maxsize=None)
+def _ring(radius, dimensions):
+    """
+    Returns: The offsets of the cells at a given L-infinity distance (in
+    cells) of a cell, in a grid of some dimensions.
+    """
+    return [offset
+            for offset in itertools.product(range(-radius, radius + 1),
+                                            repeat=dimensions)
+            if max(map(abs, offset)) == radius]
+
+
+def _cell_size(points, cell_points=_CELL_POINTS):
+    """
+    Compute the size of the cells of a grid over some points, so that cells
+    around the mean point hold about cell_points points, assuming normally
+    distributed features.
+    """
+    if len(points) < 2:
+        return 1.0
+    dimensions = len(points[0])
+    density = len(points) / (2 * math.pi)**(dimensions / 2)
+    for axis in range(dimensions):
+        values = [point[axis] for point in points]
+        mean = sum(values) / len(values)
+        std = math.sqrt(sum((x - mean)**2 for x in values) / len(values))
+        # Constant features do not spread the points
+        density /= std or 1.0
+    return (cell_points / density)**(1 / dimensions)
+
+
+class GridIndex:
+    """
+    An approximate nearest neighbours index over features tuples, bucketing
+    the points in the cells of a uniform grid over the quantised features.
+
+    A search visits the cells by rings of increasing distance around the
+    cell of the point, and stops `probes` rings after k candidates were
+    found, or as soon as no unvisited point can be closer than the k
+    candidates. Fewer probes are faster, more probes have a better recall,
+    results being exact with `probes=None`.
+
+    Results are ordered by ascending distance, ties being broken by index in
+    the list of points, as for KDTree.
+    """
+    def __init__(self, points, probes=_PROBES, cell_points=_CELL_POINTS):
+        self.points = points
+        self.probes = probes
+        self.cell_size = _cell_size(points, cell_points)
+        self.cells = {}
+        for index, point in enumerate(points):
+            self.cells.setdefault(self._cell(point), []).append(index)
+
+    def _cell(self, point):
+        return tuple(math.floor(x / self.cell_size) for x in point)
+
+    def _rings(self, center):
+        """
+        Returns: An iterator over (radius, cells) tuples, with the occupied
+        cells by ascending L-infinity distance to a cell.
+        """
+        dimensions = len(center)
+        radius = 0
+        # Look up the cells of the rings while there are fewer of them than
+        # occupied cells, which are sorted by distance beyond
+        while (2 * radius + 1)**dimensions <= len(self.cells):
+            cells = [cell for cell in (
+                tuple(c + o for c, o in zip(center, offset))
+                for offset in _ring(radius, dimensions))
+                if cell in self.cells]
+            yield radius, cells
+            radius += 1
+        remaining = {}
+        for cell in self.cells:
+            distance = max(abs(c - o) for c, o in zip(cell, center))
+            if distance >= radius:
+                remaining.setdefault(distance, []).append(cell)
+        for distance in sorted(remaining):
+            yield distance, remaining[distance]
+
+    def nearest(self, point, k=1, skip=None, probes=_INDEX_PROBES):
+        """
+        Find the approximate nearest neighbours of a point.
+
+        Params:
+            - point: A features tuple.
+            - k: Number of neighbours to return.
+            - skip: An optional function taking an index and returning
+            whether this point should be ignored.
+            - probes: Number of rings of cells visited once k candidates were
+            found, None to get exact results. Defaults to the probes of the
+            index.
+        Returns: A list of at most k (distance, index) tuples, sorted by
+        ascending distance.
+        """
+        if probes is _INDEX_PROBES:
+            probes = self.probes
+        center = self._cell(point)
+        # Distance of the point to the border of its cell (in cells), all
+        # the points out of the ring r being farther than r + margin
+        margin = min((min(x / self.cell_size - c, c + 1 - x / self.cell_size)
+                      for x, c in zip(point, center)), default=0)
+        # Max-heap of (-distance, -index), the worst candidate being on top
+        heap = []
+        extra_rings = 0
+        for radius, cells in self._rings(center):
+            for cell in cells:
+                for index in self.cells[cell]:
+                    distance = features_distance(point, self.points[index])
+                    if len(heap) == k and (distance, index) > (-heap[0][0],
+                                                               -heap[0][1]):
+                        continue
+                    if skip is not None and skip(index):
+                        continue
+                    if len(heap) == k:
+                        heapq.heapreplace(heap, (-distance, -index))
+                    else:
+                        heapq.heappush(heap, (-distance, -index))
+            if len(heap) < k:
+                continue
+            if (-heap[0][0] < (radius + margin) * self.cell_size *
+                    (1 - _PRUNING_MARGIN)):
+                # No unvisited point can be closer
+                break
+            if probes is not None and extra_rings >= probes:
+                break
+            extra_rings += 1
+        return sorted((-distance, -index) for distance, index in heap)
+
+
+def measure_recall(index, queries, k=10):
+    """
+    Measure the recall of an approximate nearest neighbours index against a
+    brute force search, i.e. the mean fraction of the true k nearest
+    neighbours it returns.
+
+    Params:
+        - index: An index with a `points` attribute and a `nearest` method.
+        - queries: Indices in index.points of the points to search the
+        neighbours of (the point itself being skipped).
+        - k: Number of neighbours searched.
+    Returns: A dict with the recall and the mean search times (in seconds)
+    of the index and of the brute force search.
+    """
+    found = 0
+    expected = 0
+    index_time = 0
+    brute_force_time = 0
+    for query in queries:
+        point = index.points[query]
+        start = time.perf_counter()
+        approximate = index.nearest(point, k, lambda i: i == query)
+        index_time += time.perf_counter() - start
+        start = time.perf_counter()
+        exact = heapq.nsmallest(
+            k, ((features_distance(point, other), i)
+                for i, other in enumerate(index.points) if i != query))
+        brute_force_time += time.perf_counter() - start
+        found += len({i for _, i in approximate} & {i for _, i in exact})
+        expected += len(exact)
+    return {
+        "recall": found / expected if expected else 1.0,
+        "index_seconds": index_time / max(len(queries), 1),
+        "brute_force_seconds": brute_force_time / max(len(queries), 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure the recall of the approximate nearest neighbours engine on the songs of the db, against a brute force search.")
+    parser.add_argument("--queries", help="Number of songs to search the neighbours of.",
+                        type=int, default=_RECALL_QUERIES)
+    parser.add_argument("--k", help="Number of neighbours searched.",
+                        type=int, default=_RECALL_K)
+    parser.add_argument("--probes", help="Probes of the approximate engine to measure.",
+                        type=int, nargs="+", default=[0, 1, 2])
+    parser.add_argument("--cell-points", help="Mean number of songs per cell of the approximate engine.",
+                        type=float, default=_CELL_POINTS)
+    parser.add_argument("--seed", help="Random seed of the queries.",
+                        type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    conn = sqlite3.connect(os.path.join(_BLISSIFY_DATA_HOME, "db.sqlite3"))
+    conn.row_factory = sqlite3.Row
+    conn.execute('pragma foreign_keys=ON')
+    schema.migrate(conn)
+    normalisation.refresh(conn)
+    points = snapshot.load(conn).points()
+    conn.close()
+
+    start = time.perf_counter()
+    index = GridIndex(points, cell_points=args.cell_points)
+    report = {
+        "songs": len(points),
+        "cells": len(index.cells),
+        "build_seconds": time.perf_counter() - start,
+        "k": args.k,
+        "results": [],
+    }
+    queries = random.Random(args.seed).sample(range(len(points)),
+                                              min(args.queries, len(points)))
+    for probes in args.probes:
+        index.probes = probes
+        logging.info("Measuring recall with %d probes." % (probes,))
+        result = measure_recall(index, queries, args.k)
+        result["probes"] = probes
+        report["results"].append(result)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,130 @@
+"""
+Normalised song features, stored in the `features` table along with their L2
+norm, so that distances are not dominated by the features with the largest
+values and cosine similarities reduce to dot products.
+
+Features are normalised to z-scores, using the means and standard deviations
+of the features over the library. Statistics are computed again when the
+library doubled in size since they were computed, or when the normalisation
+method changes. The features version stored in the `metadata` table is then
+bumped, as the caches computed from features of another version are stale.
+
+Songs whose features all equal the means have a zero norm. Their cosine
+similarity with any song is defined as 0.
+"""
+import json
+import logging
+import math
+
+import schema
+
+FEATURES = ["tempo", "amplitude", "frequency", "attack"]
+# Normalisation method, to change whenever the normalisation changes
+_METHOD = "zscore"
+# Statistics are computed again once the library grew by this factor
+_GROWTH = 2
+
+_VERSION_QUERY = schema.query(
+    "SELECT value FROM metadata WHERE name='features_version'", ["metadata"])
+_STATS_QUERY = schema.query(
+    "SELECT value FROM metadata WHERE name='features_stats'", ["metadata"])
+_MEANS_QUERY = schema.query(
+    "SELECT AVG(tempo), AVG(amplitude), AVG(frequency), AVG(attack), COUNT(*) FROM songs")
+_VARIANCES_QUERY = schema.query(
+    "SELECT AVG((tempo-?)*(tempo-?)), AVG((amplitude-?)*(amplitude-?)), AVG((frequency-?)*(frequency-?)), AVG((attack-?)*(attack-?)) FROM songs")
+_SONGS_COUNT_QUERY = schema.query("SELECT COUNT(*) FROM songs")
+_FEATURES_COUNT_QUERY = schema.query("SELECT COUNT(*) FROM features")
+_CLEAR_QUERY = schema.query("DELETE FROM features")
+_SET_STATS_QUERY = schema.query(
+    "INSERT OR REPLACE INTO metadata(name, value) VALUES('features_stats', ?)")
+_SET_VERSION_QUERY = schema.query(
+    "INSERT OR REPLACE INTO metadata(name, value) VALUES('features_version', ?)")
+_MISSING_QUERY = schema.query(
+    "SELECT songs.id, songs.tempo, songs.amplitude, songs.frequency, songs.attack FROM songs LEFT JOIN features ON features.song=songs.id WHERE features.song IS NULL",
+    ["features"])
+_INSERT_QUERY = schema.query(
+    "INSERT INTO features(song, tempo, amplitude, frequency, attack, norm) VALUES(?, ?, ?, ?, ?, ?)")
+
+
+def get_version(conn):
+    """
+    Returns: The version of the normalised features, 0 if they were never
+    computed.
+    """
+    row = conn.execute(_VERSION_QUERY).fetchone()
+    return int(row[0]) if row is not None else 0
+
+
+def load_stats(conn):
+    """
+    Returns: The normalisation statistics, as a dict with method, count,
+    mean and std keys, or None if they were never computed.
+    """
+    row = conn.execute(_STATS_QUERY).fetchone()
+    return json.loads(row[0]) if row is not None else None
+
+
+def compute_stats(conn):
+    """
+    Compute the means and standard deviations of the features of the songs.
+    """
+    means = conn.execute(_MEANS_QUERY).fetchone()
+    variances = conn.execute(
+        _VARIANCES_QUERY,
+        [mean for mean in means[:4] for _ in range(2)]).fetchone()
+    return {
+        "method": _METHOD,
+        "count": means[4],
+        "mean": list(means[:4]),
+        # Constant features are left unscaled
+        "std": [math.sqrt(variance) or 1.0 for variance in variances],
+    }
+
+
+def normalise(song, stats):
+    """
+    Returns: The normalised features tuple of a song dict.
+    """
+    return tuple((song[feature] - mean) / std
+                 for feature, mean, std in zip(FEATURES, stats["mean"],
+                                               stats["std"]))
+
+
+def refresh(conn):
+    """
+    Store the normalised features of the songs missing from the features
+    table, normalising all the songs again if the statistics are outdated.
+
+    Returns: The version of the normalised features.
+    """
+    if not schema.has_table(conn, "features"):
+        # Tables are created by blissify on first run
+        return 0
+    count = conn.execute(_SONGS_COUNT_QUERY).fetchone()[0]
+    version = get_version(conn)
+    if count == 0:
+        return version
+    stats = load_stats(conn)
+    if (stats is not None and stats["method"] == _METHOD and
+            count <= _GROWTH * stats["count"] and
+            conn.execute(_FEATURES_COUNT_QUERY).fetchone()[0] == count):
+        # All the songs are normalised already, the features of removed
+        # songs being deleted in cascade
+        return version
+    with conn:
+        if (stats is None or stats["method"] != _METHOD or
+                count > _GROWTH * stats["count"]):
+            stats = compute_stats(conn)
+            version += 1
+            logging.info("Normalising features of %d songs (version %d)." %
+                         (count, version))
+            conn.execute(_CLEAR_QUERY)
+            conn.execute(_SET_STATS_QUERY, (json.dumps(stats),))
+            conn.execute(_SET_VERSION_QUERY, (str(version),))
+        rows = []
+        for song in conn.execute(_MISSING_QUERY).fetchall():
+            vector = normalise(dict(zip(FEATURES, song[1:])), stats)
+            rows.append((song[0],) + vector +
+                        (math.sqrt(sum(x * x for x in vector)),))
+        conn.executemany(_INSERT_QUERY, rows)
+    return version
@@ -0,0 +1,162 @@
+"""
+Planning of whole song-based mixes, used by `client.py --plan`.
+
+Instead of picking the closest song of the last one at each step, which can
+lead the mix into a corner of the features space, a beam search keeps the
+`beam_width` sequences with the lowest total distance at each step, and
+returns the best one once the mix is long enough. With a beam width of 1, it
+is the greedy search of `client.py`.
+
+_Note_: `numpy` is used to score the candidates of all the sequences at once
+if available. The scalar engine is kept as a reference implementation.
+`numpy` is only imported on the first plan, as importing it takes longer than
+the startup of `client.py`.
+"""
+import functools
+import math
+import sys
+
+import knn
+
+_BEAM_WIDTH = 8
+_EPSILON = sys.float_info.epsilon
+
+
+@functools.lru_cache(maxsize=None)
+def _numpy():
+    """
+    Returns: The numpy module, imported on first call, or None if it is not
+    available.
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def plan_scalar(songs, start, length, beam_width=_BEAM_WIDTH, excluded=()):
+    """
+    Plan a mix with the scalar reference engine.
+
+    Params: See `plan`.
+    Returns: See `plan`.
+    """
+    points = songs.points()
+    count = len(points)
+    excluded = set(excluded)
+    excluded.add(start)
+    # Sequences as (total distance, [(distance, index)], visited indices)
+    beams = [(0.0, [], excluded)]
+    for _ in range(length):
+        candidates = []
+        for beam, (total, path, visited) in enumerate(beams):
+            last = points[path[-1][1] if path else start]
+            for index in range(count):
+                if index in visited:
+                    continue
+                distance = knn.features_distance(last, points[index])
+                # Ties broken as by the numpy engine
+                candidates.append((total + distance, beam * count + index,
+                                   distance))
+        if not candidates:
+            break
+        candidates.sort()
+        next_beams = []
+        for total, position, distance in candidates[:beam_width]:
+            beam, index = divmod(position, count)
+            _, path, visited = beams[beam]
+            next_beams.append((total, path + [(distance, index)],
+                               visited | {index}))
+        beams = next_beams
+    return beams[0][1]
+
+
+def plan_numpy(songs, start, length, beam_width=_BEAM_WIDTH, excluded=()):
+    """
+    Plan a mix with the numpy engine, scoring the candidates of all the
+    sequences in a single (beam_width, n) array at each step.
+
+    Candidates are scored with approximate distances computed with a matrix
+    product, the best ones being ranked again with the exact distances, so
+    that results match the scalar engine.
+
+    Params: See `plan`.
+    Returns: See `plan`.
+    """
+    numpy = _numpy()
+    # Zero-copy view of the snapshot, converted once to double precision to
+    # match the scalar engine
+    points = numpy.frombuffer(songs.features, dtype=numpy.float32).reshape(
+        -1, 4).astype(numpy.float64)
+    axes = points.T.copy()
+    squares = numpy.einsum("ij,ij->i", points, points)
+    count = len(points)
+    # Bound on the error of the approximate distances
+    margin = 8 * math.sqrt(squares.max(initial=0) * _EPSILON)
+    visited = numpy.zeros((1, count), dtype=bool)
+    visited[0, list(excluded)] = True
+    visited[0, start] = True
+    lasts = numpy.array([start])
+    totals = numpy.zeros(1)
+    paths = numpy.empty((1, 0), dtype=numpy.int64)
+    distances = numpy.empty((1, 0))
+    for _ in range(length):
+        nb_candidates = min(beam_width, int(numpy.count_nonzero(~visited)))
+        if nb_candidates == 0:
+            break
+        # Approximate distances between the last songs of the sequences and
+        # all the songs, as |x|^2 + |y|^2 - 2 x.y
+        scores = points[lasts] @ axes
+        scores *= -2
+        scores += squares
+        scores += squares[lasts][:, None]
+        numpy.maximum(scores, 0, out=scores)
+        numpy.sqrt(scores, out=scores)
+        scores += totals[:, None]
+        numpy.putmask(scores, visited, numpy.inf)
+        scores = scores.ravel()
+        threshold = numpy.partition(scores, nb_candidates - 1)[
+            nb_candidates - 1]
+        positions = numpy.flatnonzero(
+            scores <= threshold * (1 + 4 * _EPSILON) + margin)
+        beams, candidates = numpy.divmod(positions, count)
+        # Exact distances of the best candidates
+        step_distances = numpy.zeros(len(positions))
+        for axis in axes:
+            diff = axis[lasts[beams]] - axis[candidates]
+            step_distances += diff * diff
+        numpy.sqrt(step_distances, out=step_distances)
+        candidate_totals = totals[beams] + step_distances
+        # Sort by total distance, then by position for stable ties
+        best = numpy.lexsort((positions, candidate_totals))[:nb_candidates]
+        beams = beams[best]
+        candidates = candidates[best]
+        totals = candidate_totals[best]
+        paths = numpy.column_stack([paths[beams], candidates])
+        distances = numpy.column_stack([distances[beams],
+                                        step_distances[best]])
+        visited = visited[beams]
+        visited[numpy.arange(nb_candidates), candidates] = True
+        lasts = candidates
+    return list(zip(distances[0].tolist(), paths[0].tolist()))
+
+
+def plan(songs, start, length, beam_width=_BEAM_WIDTH, excluded=()):
+    """
+    Plan a mix, minimizing the sum of the distances between its consecutive
+    songs with a beam search.
+
+    Params:
+        - songs: A snapshot of all the songs.
+        - start: Index of the current song in the snapshot.
+        - length: Number of songs to add to the mix.
+        - beam_width: Number of sequences kept at each step.
+        - excluded: Indices of the songs not to add to the mix.
+    Returns: A list of at most length (distance, index) tuples, with the
+    indices of the songs of the mix and their distances to the previous
+    song.
+    """
+    if _numpy() is not None:
+        return plan_numpy(songs, start, length, beam_width, excluded)
+    return plan_scalar(songs, start, length, beam_width, excluded)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Read-only replica of the blissify db, read by `client.py --replica` so that
+mix generation does not contend with the writes of `server.py`, `blissify`
+and `build_cache.py` on the db.
+
+The replica is a consistent copy of the tables read by `client.py`, taken by
+the writing scripts (`--replica` option) once their changes are committed.
+The distances cache, the manifest and the errors are left out, so that the
+read lock held on the db during the copy, which blocks the commits of the
+`blissify` processes, is short. It is written to a temporary file,
+atomically renamed over the previous replica. As it is never modified in
+place, clients open it as immutable, without taking any lock, and keep
+reading the replica they opened until they open it again.
+
+Run `python3 replica.py` to publish the replica by hand.
+"""
+import argparse
+import logging
+import os
+import pathlib
+import sqlite3
+
+import instrument
+import normalisation
+import schema
+import snapshot
+
+if "XDG_DATA_HOME" in os.environ:
+    _BLISSIFY_DATA_HOME = os.path.expandvars("$XDG_DATA_HOME/blissify")
+else:
+    _BLISSIFY_DATA_HOME = os.path.expanduser("~/.local/share/blissify")
+
+# Tables and views read by client.py
+_TABLES = ["songs", "features", "song_features", "neighbours",
+           "album_centroids", "metadata"]
+_SCHEMA_QUERY = schema.query(
+    "SELECT type, name, sql FROM source.sqlite_master WHERE tbl_name IN (%s) AND type IN ('table', 'index', 'view') AND sql IS NOT NULL" %
+    (", ".join("'%s'" % (name,) for name in _TABLES),))
+
+
+def publish(conn, path):
+    """
+    Publish a replica of the db, atomically replacing the previous one. The
+    features of the songs are normalised first, so that clients do not have
+    to write to the replica.
+
+    Params:
+        - conn: An SQLite connection to the blissify db, without any pending
+        transaction.
+        - path: Path of the replica.
+    Returns: The (db identifier, generation) tuple of the replica, or None
+    if the db is empty and no replica was published.
+    """
+    if not schema.has_table(conn, "songs"):
+        # Tables are created by blissify on first run
+        return None
+    normalisation.refresh(conn)
+    db_path = conn.execute("PRAGMA database_list").fetchone()[2]
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with instrument.timer("replica_publish"):
+        try:
+            replica = sqlite3.connect(tmp_path, isolation_level=None)
+            try:
+                # The temporary file is only renamed once complete
+                replica.execute("PRAGMA journal_mode=OFF")
+                replica.execute("PRAGMA synchronous=OFF")
+                replica.execute("ATTACH DATABASE ? AS source", (db_path,))
+                # Tables are copied in a single read transaction on the db,
+                # for a consistent replica, indexes being built afterwards
+                replica.execute("BEGIN")
+                objects = replica.execute(_SCHEMA_QUERY).fetchall()
+                for kind, name, sql in objects:
+                    if kind == "table":
+                        replica.execute(sql)
+                        replica.execute(
+                            'INSERT INTO main."%s" SELECT * FROM source."%s"' %
+                            (name, name))
+                replica.execute("COMMIT")
+                replica.execute("DETACH DATABASE source")
+                for kind, name, sql in objects:
+                    if kind != "table":
+                        replica.execute(sql)
+                generation = snapshot.get_generation(replica)
+            finally:
+                replica.close()
+            with open(tmp_path, "rb") as fh:
+                os.fsync(fh.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    size = os.path.getsize(path)
+    instrument.count("replica_bytes_published", size)
+    logging.info("Published replica %s (%d bytes, generation %s)." %
+                 (path, size, generation[1] if generation else None))
+    return generation
+
+
+def connect(path):
+    """
+    Open the replica, read-only and immutable.
+
+    Returns: An SQLite connection to the replica, returning sqlite3.Row
+    rows.
+    Raises: FileNotFoundError if no replica was published yet.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError("Replica %s not found." % (path,))
+    conn = sqlite3.connect(
+        "%s?mode=ro&immutable=1" % (pathlib.Path(path).absolute().as_uri(),),
+        uri=True)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    db_path = os.path.join(_BLISSIFY_DATA_HOME, "db.sqlite3")
+    logging.debug("Using DB path: %s." % (db_path,))
+    conn = sqlite3.connect(db_path)
+    conn.execute('pragma foreign_keys=ON')
+    schema.migrate(conn)
+    publish(conn, os.path.join(_BLISSIFY_DATA_HOME, "replica.sqlite3"))
+    conn.close()
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+Extensions of the blissify db schema maintained on the Python side, on top of
+the tables created by `blissify`.
+
+Schema changes are applied as numbered migrations, the current schema version
+being stored in the `metadata` table. They are applied by the other scripts
+when opening the db, and can be applied manually by running this script.
+
+Run `python3 schema.py --help` for more infos on how to use.
+"""
+import argparse
+import importlib
+import logging
+import os
+import re
+import sqlite3
+import sys
+
+if "XDG_DATA_HOME" in os.environ:
+    _BLISSIFY_DATA_HOME = os.path.expandvars("$XDG_DATA_HOME/blissify")
+else:
+    _BLISSIFY_DATA_HOME = os.path.expanduser("~/.local/share/blissify")
+
+# Scripts running queries on the db, imported to register their queries
+_SCRIPTS = ["client", "server", "normalisation", "snapshot", "build_cache"]
+_SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, "scripts")
+# Queries run by the scripts, along with the tables they should never fully
+# scan, registered by `query`
+_QUERY_PLANS = []
+# Tables created by the scripts when needed, registered by `table`
+_TABLES = []
+
+
+def query(sql, indexed_tables=()):
+    """
+    Register a query run by the scripts, for `check_query_plans`. Queries
+    are meant to be module-level constants of the scripts, defined with this
+    function.
+
+    Params:
+        - sql: The query.
+        - indexed_tables: The tables the query should never fully scan.
+    Returns: The query.
+    """
+    _QUERY_PLANS.append((sql, list(indexed_tables)))
+    return sql
+
+
+def table(sql):
+    """
+    Register the creation of a table created by the scripts when needed, so
+    that `check_query_plans` checks the queries on it even if it does not
+    exist in the db.
+
+    Returns: The table creation query.
+    """
+    _TABLES.append(sql)
+    return sql
+
+
+_HAS_TABLE_QUERY = query(
+    "SELECT name FROM sqlite_master WHERE type='table' AND name=?")
+_VERSION_QUERY = query(
+    "SELECT value FROM metadata WHERE name='schema_version'", ["metadata"])
+_SET_VERSION_QUERY = query(
+    "INSERT OR REPLACE INTO metadata(name, value) VALUES('schema_version', ?)")
+# Queries run by triggers and foreign keys ON DELETE CASCADE
+query("UPDATE metadata SET value=value+1 WHERE name='generation'", ["metadata"])
+query("DELETE FROM distances WHERE song1=?", ["distances"])
+query("DELETE FROM distances WHERE song2=?", ["distances"])
+query("DELETE FROM neighbours WHERE song=?", ["neighbours"])
+query("DELETE FROM neighbours WHERE neighbour=?", ["neighbours"])
+query("DELETE FROM features WHERE song=?", ["features"])
+
+
+def has_table(conn, name):
+    """
+    Returns: Whether a table exists in the db.
+    """
+    return conn.execute(_HAS_TABLE_QUERY, (name,)).fetchone() is not None
+
+
+def init_album_centroids(conn):
+    """
+    Create the album_centroids table, storing the mean features and the
+    number of songs of each album, and the triggers keeping it up to date
+    when songs are added, updated or removed. The table is filled from the
+    songs table when created.
+    """
+    if has_table(conn, "album_centroids"):
+        return
+    logging.info("Building album centroids table.")
+    # Triggers look up the songs of an album
+    conn.execute("CREATE INDEX IF NOT EXISTS songs_album ON songs(album)")
+    conn.execute("CREATE TABLE album_centroids( \
+        album TEXT PRIMARY KEY, \
+        tempo REAL, \
+        amplitude REAL, \
+        frequency REAL, \
+        attack REAL, \
+        count INTEGER)")
+    conn.execute("INSERT INTO album_centroids(album, tempo, amplitude, frequency, attack, count) \
+        SELECT album, AVG(tempo), AVG(amplitude), AVG(frequency), AVG(attack), COUNT(*) \
+        FROM songs WHERE album IS NOT NULL GROUP BY album")
+    conn.execute("CREATE TRIGGER album_centroids_insert AFTER INSERT ON songs BEGIN \
+        INSERT OR REPLACE INTO album_centroids(album, tempo, amplitude, frequency, attack, count) \
+        SELECT album, AVG(tempo), AVG(amplitude), AVG(frequency), AVG(attack), COUNT(*) \
+        FROM songs WHERE album=NEW.album GROUP BY album; \
+    END")
+    conn.execute("CREATE TRIGGER album_centroids_delete AFTER DELETE ON songs BEGIN \
+        DELETE FROM album_centroids WHERE album=OLD.album; \
+        INSERT INTO album_centroids(album, tempo, amplitude, frequency, attack, count) \
+        SELECT album, AVG(tempo), AVG(amplitude), AVG(frequency), AVG(attack), COUNT(*) \
+        FROM songs WHERE album=OLD.album GROUP BY album; \
+    END")
+    conn.execute("CREATE TRIGGER album_centroids_update AFTER UPDATE OF tempo, amplitude, frequency, attack, album ON songs BEGIN \
+        DELETE FROM album_centroids WHERE album=OLD.album; \
+        INSERT OR REPLACE INTO album_centroids(album, tempo, amplitude, frequency, attack, count) \
+        SELECT album, AVG(tempo), AVG(amplitude), AVG(frequency), AVG(attack), COUNT(*) \
+        FROM songs WHERE album IN (OLD.album, NEW.album) GROUP BY album; \
+    END")
+
+
+def init_indexes(conn):
+    """
+    Create the indexes used by the scripts queries and by the ON DELETE
+    CASCADE foreign keys.
+    """
+    # Covering index for the songs of an album, replacing songs_album
+    conn.execute("CREATE INDEX IF NOT EXISTS songs_album_features ON songs(album, tempo, amplitude, frequency, attack, filename)")
+    conn.execute("DROP INDEX IF EXISTS songs_album")
+    conn.execute("CREATE INDEX IF NOT EXISTS distances_song2 ON distances(song2)")
+    init_neighbours_index(conn)
+
+
+def init_neighbours_index(conn):
+    """
+    Create the index used to delete the neighbours of a removed song, if the
+    neighbours table exists.
+    """
+    if has_table(conn, "neighbours"):
+        conn.execute("CREATE INDEX IF NOT EXISTS neighbours_neighbour ON neighbours(neighbour)")
+
+
+def init_manifest(conn):
+    """
+    Create the manifest table, storing the size, modification time and
+    optional content hash of the analyzed files.
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS manifest( \
+        filename TEXT PRIMARY KEY, \
+        size INTEGER, \
+        mtime INTEGER, \
+        hash TEXT)")
+
+
+def init_manifest_hash_index(conn):
+    """
+    Create the index used to look up renamed files by content hash.
+    """
+    conn.execute("CREATE INDEX IF NOT EXISTS manifest_hash ON manifest(hash)")
+
+
+def init_error_retries(conn):
+    """
+    Create the error_retries table, storing the number of failed retries,
+    the last error and the time of the next retry of the errored files.
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS error_retries( \
+        filename TEXT PRIMARY KEY, \
+        attempts INTEGER, \
+        last_error TEXT, \
+        next_retry INTEGER)")
+
+
+def init_features(conn):
+    """
+    Create the features table, storing the normalised features of the songs
+    and their L2 norm (filled by `normalisation.refresh`), and the
+    song_features view, exposing them with the columns of the songs table.
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS features( \
+        song INTEGER PRIMARY KEY, \
+        tempo REAL, \
+        amplitude REAL, \
+        frequency REAL, \
+        attack REAL, \
+        norm REAL, \
+        FOREIGN KEY(song) REFERENCES songs(id) ON DELETE CASCADE)")
+    conn.execute("CREATE VIEW IF NOT EXISTS song_features AS \
+        SELECT songs.id AS id, features.tempo AS tempo, \
+        features.amplitude AS amplitude, features.frequency AS frequency, \
+        features.attack AS attack, features.norm AS norm, \
+        songs.filename AS filename, songs.album AS album \
+        FROM songs JOIN features ON features.song=songs.id")
+    # Features of updated songs are normalised again on next refresh
+    conn.execute("CREATE TRIGGER IF NOT EXISTS features_update AFTER UPDATE OF tempo, amplitude, frequency, attack ON songs BEGIN \
+        DELETE FROM features WHERE song=OLD.id; \
+    END")
+
+
+def init_generation(conn):
+    """
+    Create the db generation counter and the identifier of the db in the
+    metadata table, and the triggers bumping the generation whenever the
+    normalised features, filenames or albums of the songs change, to
+    invalidate the snapshots of the song features.
+    """
+    conn.execute("INSERT OR IGNORE INTO metadata(name, value) VALUES('generation', '0')")
+    conn.execute("INSERT OR IGNORE INTO metadata(name, value) VALUES('db_id', ?)",
+                 (os.urandom(16).hex(),))
+    # Removed and updated songs are removed from the features table
+    conn.execute("CREATE TRIGGER IF NOT EXISTS generation_features_insert AFTER INSERT ON features BEGIN \
+        UPDATE metadata SET value=value+1 WHERE name='generation'; \
+    END")
+    conn.execute("CREATE TRIGGER IF NOT EXISTS generation_features_delete AFTER DELETE ON features BEGIN \
+        UPDATE metadata SET value=value+1 WHERE name='generation'; \
+    END")
+    conn.execute("CREATE TRIGGER IF NOT EXISTS generation_songs_update AFTER UPDATE OF filename, album ON songs BEGIN \
+        UPDATE metadata SET value=value+1 WHERE name='generation'; \
+    END")
+
+
+# Migrations, version n being reached after applying the n first ones
+_MIGRATIONS = [
+    init_album_centroids,
+    init_indexes,
+    init_manifest,
+    init_manifest_hash_index,
+    init_error_retries,
+    init_features,
+    init_generation,
+]
+
+
+def get_version(conn):
+    """
+    Returns: The schema version of the db.
+    """
+    row = conn.execute(_VERSION_QUERY).fetchone()
+    return int(row[0]) if row is not None else 0
+
+
+def migrate(conn):
+    """
+    Apply the pending migrations to the db, each one in its own transaction
+    with the update of the schema version.
+
+    Returns: The schema version of the db.
+    """
+    if not has_table(conn, "songs") or not has_table(conn, "metadata"):
+        # Tables are created by blissify on first run
+        return 0
+    version = get_version(conn)
+    for migration in _MIGRATIONS[version:]:
+        version += 1
+        logging.info("Migrating db to schema version %d." % (version,))
+        with conn:
+            conn.execute("BEGIN")
+            migration(conn)
+            conn.execute(_SET_VERSION_QUERY, (str(version),))
+    return version
+
+
+def check_query_plans(conn):
+    """
+    Check the query plans of the queries run by the scripts, using
+    `EXPLAIN QUERY PLAN`. The scripts are imported to register their queries,
+    and the tables they create when needed are created in a transaction,
+    rolled back once the queries are checked.
+
+    Returns: A list of (query, plan) tuples for the queries fully scanning a
+    table they should not. Queries on missing tables are ignored.
+    """
+    sys.path.append(_SCRIPTS_DIR)
+    for script in _SCRIPTS:
+        importlib.import_module(script)
+    # Tables not to fully scan of each distinct query
+    query_plans = {}
+    for sql, indexed_tables in _QUERY_PLANS:
+        query_plans.setdefault(sql, set()).update(indexed_tables)
+    failures = []
+    conn.execute("BEGIN")
+    try:
+        for sql in _TABLES:
+            try:
+                conn.execute(sql)
+            except sqlite3.OperationalError:
+                logging.debug("Skipping table creation: %s" % (sql,))
+        init_neighbours_index(conn)
+        for sql, indexed_tables in query_plans.items():
+            try:
+                plan = conn.execute("EXPLAIN QUERY PLAN %s" % (sql,),
+                                    (None,) * sql.count("?")).fetchall()
+            except sqlite3.OperationalError:
+                logging.debug("Skipping query on missing table: %s" % (sql,))
+                continue
+            details = [row[3] for row in plan]
+            logging.debug("%s\n    %s" % (sql, "\n    ".join(details)))
+            for indexed_table in sorted(indexed_tables):
+                if any(re.match(r"SCAN (TABLE )?%s\b" % (indexed_table,),
+                                detail)
+                       for detail in details):
+                    failures.append((sql, details))
+                    break
+    finally:
+        conn.rollback()
+    return failures
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--check-query-plans",
+                        help="Check that the scripts queries use indexes.",
+                        action="store_true", default=False)
+    parser.add_argument("--verbose", help="Print all the query plans.",
+                        action="store_true", default=False)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    db_path = os.path.join(_BLISSIFY_DATA_HOME, "db.sqlite3")
+    logging.debug("Using DB path: %s." % (db_path,))
+    conn = sqlite3.connect(db_path)
+    conn.execute('pragma foreign_keys=ON')
+    logging.info("DB schema version is %d." % (migrate(conn),))
+    if args.check_query_plans:
+        # Queries are registered in the schema module imported by the
+        # scripts, not in __main__
+        import schema
+        failures = schema.check_query_plans(conn)
+        for query, details in failures:
+            logging.error("Full table scan in: %s\n    %s" %
+                          (query, "\n    ".join(details)))
+        conn.close()
+        sys.exit(1 if failures else 0)
+    conn.close()
@@ -7,20 +7,118 @@ Run `python3 server.py --help` for more infos on how to use.
 _Note_: `blissify` should be available in your `$PATH`.
 """
 import argparse
+import concurrent.futures
 import dateutil.parser
+import hashlib
+import itertools
 import logging
 import os
+import queue
 import shutil
 import sqlite3
 import subprocess
+import sys
+import threading
+import time
 
-from mpd import MPDClient
+from mpd import MPDClient, MPDError
+
+import instrument
+import replica
+import schema
 
 if "XDG_DATA_HOME" in os.environ:
     _BLISSIFY_DATA_HOME = os.path.expandvars("$XDG_DATA_HOME/blissify")
 else:
     _BLISSIFY_DATA_HOME = os.path.expanduser("~/.local/share/blissify")
 
+# Number of blissify processes to run in parallel
+_JOBS = os.cpu_count() or 1
+# Batches are sized so that a blissify run lasts about _BATCH_DURATION seconds
+_BATCH_SIZE = 100
+_MIN_BATCH_SIZE = 10
+_MAX_BATCH_SIZE = 1000
+_BATCH_DURATION = 120
+# Number of attempts for a failing blissify run
+_RETRIES = 3
+# Script maintaining the distances cache
+_BUILD_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, "scripts", "build_cache.py")
+# Number of songs fetched from MPD per request
+_PAGE_SIZE = 1000
+# In listen mode, the db is updated once no event happened for
+# _DEBOUNCE_DELAY seconds, or at most _MAX_DEBOUNCE_DELAY seconds after the
+# first event of a burst
+_DEBOUNCE_DELAY = 5
+_MAX_DEBOUNCE_DELAY = 60
+# Errored files are retried by isolated batches of _ERRORS_BATCH_SIZE files,
+# at most _MAX_ERRORS_PER_PASS per run. The delay before the next retry starts
+# from _ERROR_RETRY_DELAY seconds and doubles after each failure, files being
+# skipped after _MAX_ERROR_ATTEMPTS failed retries.
+_ERRORS_BATCH_SIZE = 20
+_MAX_ERRORS_PER_PASS = 1000
+_ERROR_RETRY_DELAY = 3600
+_MAX_ERROR_ATTEMPTS = 5
+# Number of bytes hashed at the beginning and at the end of a file
+_HASH_CHUNK_SIZE = 1024 * 1024
+# During a scan, the replica of the db is published again at most every
+# _REPLICA_INTERVAL seconds
+_REPLICA_INTERVAL = 600
+
+# Filenames enumerated by a full scan
+_SCANNED_SCHEMA = schema.table(
+    "CREATE TEMP TABLE scanned(filename TEXT PRIMARY KEY)")
+_INSERT_SCANNED_QUERY = schema.query(
+    "INSERT OR IGNORE INTO temp.scanned(filename) VALUES(?)")
+_REMOVED_QUERY = schema.query(
+    "SELECT filename FROM manifest WHERE filename NOT IN (SELECT filename FROM temp.scanned)",
+    ["scanned"])
+_MANIFEST_QUERY = schema.query(
+    "SELECT size, mtime, hash FROM manifest WHERE filename=?", ["manifest"])
+_MANIFEST_HASH_QUERY = schema.query(
+    "SELECT filename FROM manifest WHERE hash=?", ["manifest"])
+_INSERT_MANIFEST_QUERY = schema.query(
+    "INSERT OR REPLACE INTO manifest(filename, size, mtime, hash) VALUES(?, ?, ?, ?)")
+_SONG_ID_QUERY = schema.query("SELECT id FROM songs WHERE filename=?",
+                              ["songs"])
+_ERROR_ID_QUERY = schema.query("SELECT id FROM errors WHERE filename=?",
+                               ["errors"])
+_FILENAMES_QUERY = schema.query(
+    "SELECT filename FROM songs UNION SELECT filename FROM errors")
+_KNOWN_FILENAMES_QUERY = schema.query(
+    "SELECT filename FROM songs UNION SELECT filename FROM errors UNION SELECT filename FROM manifest")
+_RENAME_SONG_QUERY = schema.query(
+    "UPDATE songs SET filename=? WHERE filename=?", ["songs"])
+_RENAME_ERROR_QUERY = schema.query(
+    "UPDATE errors SET filename=? WHERE filename=?", ["errors"])
+_RENAME_MANIFEST_QUERY = schema.query(
+    "UPDATE manifest SET filename=?, mtime=? WHERE filename=?", ["manifest"])
+_RENAME_RETRIES_QUERY = schema.query(
+    "UPDATE error_retries SET filename=? WHERE filename=?", ["error_retries"])
+_DELETE_SONG_QUERY = schema.query("DELETE FROM songs WHERE filename=?",
+                                  ["songs"])
+_DELETE_ERROR_QUERY = schema.query("DELETE FROM errors WHERE filename=?",
+                                   ["errors"])
+_DELETE_MANIFEST_QUERY = schema.query(
+    "DELETE FROM manifest WHERE filename=?", ["manifest"])
+_DELETE_RETRIES_QUERY = schema.query(
+    "DELETE FROM error_retries WHERE filename=?", ["error_retries"])
+_PURGE_QUERIES = [
+    schema.query("DELETE FROM %s" % (table,))
+    for table in ["distances", "songs", "errors", "error_retries", "manifest"]
+] + [
+    # Blocks stored by an interrupted parallel build_cache.py run
+    schema.query("DELETE FROM metadata WHERE name='cache_checkpoint'",
+                 ["metadata"]),
+]
+_DUE_ERRORS_QUERY = schema.query(
+    "SELECT errors.filename FROM errors LEFT JOIN error_retries ON error_retries.filename=errors.filename WHERE error_retries.filename IS NULL OR (error_retries.attempts<? AND error_retries.next_retry<=?) ORDER BY error_retries.next_retry LIMIT ?",
+    ["error_retries"])
+_RETRY_ATTEMPTS_QUERY = schema.query(
+    "SELECT attempts FROM error_retries WHERE filename=?", ["error_retries"])
+_INSERT_RETRY_QUERY = schema.query(
+    "INSERT OR REPLACE INTO error_retries(filename, attempts, last_error, next_retry) VALUES(?, ?, ?, ?)")
+
 
 def init_connection():
     """
@@ -29,6 +127,7 @@ def init_connection():
     # Get MPD connection settings
     try:
         mpd_host = os.environ["MPD_HOST"]
+        mpd_password = None
         if "@" in mpd_host:
             mpd_password, mpd_host = mpd_host.split("@")
     except KeyError:
@@ -40,10 +139,13 @@ def init_connection():
         mpd_port = 6600
 
     # Connect to MPD
+    instrument.count("mpd_connections")
     client = MPDClient()
-    client.connect(mpd_host, mpd_port)
-    if mpd_password is not None:
-        client.password(mpd_password)
+    with instrument.timer("mpd_connect"):
+        client.connect(mpd_host, mpd_port)
+        if mpd_password is not None:
+            instrument.count("mpd_commands")
+            client.password(mpd_password)
     return client
 
 
@@ -51,127 +153,736 @@ def close_connection(client):
     """
     Closes an MPDClient connection.
     """
+    instrument.count("mpd_commands")
     client.close()
     client.disconnect()
 
 
-def full_rescan(mpd_root):
+def init_db_connection():
     """
-    Perform a full rescan of the MPD library.
+    Returns an SQLite connection to the blissify db.
     """
-    # Connect to db
+    # Ensure data folder exists
+    os.makedirs(_BLISSIFY_DATA_HOME, exist_ok=True)
     db_path = os.path.join(_BLISSIFY_DATA_HOME, "db.sqlite3")
     logging.debug("Using DB path: %s." % (db_path,))
-    # Backup database
-    backup_db_path = "%s.old" % (db_path,)
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    conn.execute('pragma foreign_keys=ON')
+    schema.migrate(conn)
+    return conn
+
+
+def file_size(mpd_root, song):
+    """
+    Returns: The size of a song file, or None if it cannot be read.
+    """
     try:
-        shutil.copy(db_path, "%s" % (backup_db_path,))
-        print(("DB is saved as %s. You can remove this file manually " +
-               "at the end of the proces if you want.") % (backup_db_path,))
-    except FileNotFoundError:
-        pass
-    # Empty database
+        return os.stat(os.path.join(mpd_root, song)).st_size
+    except OSError:
+        return None
+
+
+def file_hash(mpd_root, song):
+    """
+    Compute a fast content hash of a song file, using its size and its first
+    and last bytes.
+
+    Returns: The hex digest, or None if the file cannot be read.
+    """
+    instrument.count("files_hashed")
     try:
-        conn = sqlite3.connect(db_path)
-        conn.row_factory = sqlite3.Row
-        conn.execute('pragma foreign_keys=ON')
-        cur = conn.cursor()
-        # Purge db
-        cur.executescript("BEGIN TRANSACTION; DELETE FROM distances; DELETE FROM songs; DELETE FROM errors; COMMIT;")
-        conn.close()
-    except sqlite3.OperationalError:
-        pass
+        with instrument.timer("file_hash"), \
+                open(os.path.join(mpd_root, song), "rb") as fh:
+            size = os.fstat(fh.fileno()).st_size
+            digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+            digest.update(fh.read(_HASH_CHUNK_SIZE))
+            if size > 2 * _HASH_CHUNK_SIZE:
+                fh.seek(-_HASH_CHUNK_SIZE, os.SEEK_END)
+                digest.update(fh.read(_HASH_CHUNK_SIZE))
+            return digest.hexdigest()
+    except OSError:
+        return None
+
 
+class Library:
+    """
+    Lazy enumeration of the songs of the MPD library, in ascending
+    modification time order, as (song, mtime) tuples.
+
+    Songs are fetched by pages of `page_size` songs, opening a new MPD
+    connection for each page so that it does not time out while the songs
+    are being analyzed. The `mtime` attribute is the modification time of the
+    last enumerated song, all the songs modified before it having been
+    enumerated already.
+    """
+    def __init__(self, since=None, page_size=_PAGE_SIZE):
+        self.mtime = since
+        self.page_size = page_size
+
+    def __iter__(self):
+        # Songs modified at self.mtime which were already enumerated, skipped
+        # as `modified-since` includes them
+        seen = set()
+        while True:
+            client = init_connection()
+            try:
+                instrument.count("mpd_commands")
+                with instrument.timer("mpd_find"):
+                    entries = client.find(
+                        "modified-since", self.mtime or 0,
+                        "sort", "Last-Modified",
+                        "window", "%d:%d" % (len(seen),
+                                             len(seen) + self.page_size))
+            finally:
+                close_connection(client)
+            instrument.count("songs_enumerated", len(entries))
+            for entry in entries:
+                if "file" not in entry:
+                    continue
+                song = entry["file"]
+                mtime = int(
+                    dateutil.parser.parse(entry["last-modified"]).timestamp())
+                if mtime != self.mtime:
+                    self.mtime = mtime
+                    seen = set()
+                elif song in seen:
+                    continue
+                seen.add(song)
+                yield song, mtime
+            if len(entries) < self.page_size:
+                return
+
+
+def iter_unlisted(conn, library):
+    """
+    Enumerate the songs modified since the last scan, then the songs of the
+    library missing from the db but modified before it, which
+    `modified-since` does not list (e.g. files moved or copied keeping their
+    modification time).
+
+    Params:
+        - conn: An SQLite connection to the blissify db.
+        - library: A Library enumerating the songs modified since the last
+        scan.
+    Returns: A generator of (song, mtime) tuples.
+    """
+    listed = set()
+    for song, mtime in library:
+        listed.add(song)
+        yield song, mtime
+    if not schema.has_table(conn, "manifest"):
+        # Tables are created by blissify on first run
+        return
+    known = {row["filename"]
+             for row in conn.execute(_KNOWN_FILENAMES_QUERY).fetchall()}
     client = init_connection()
-    # Get all songs from MPD and Blissify them
-    all_songs = [x["file"] for x in client.listall() if "file" in x]
-    nb_songs = len(all_songs)
-    for i in range(int(len(all_songs) / 100)):
-        subprocess.check_call(["blissify", mpd_root] + all_songs[i*100:(i+1)*100])
-    subprocess.check_call(["blissify", mpd_root] + all_songs[len(all_songs) - (len(all_songs) % 100):len(all_songs)])
-
-    # Update the latest mtime stored
-    latest_mtime = 0
+    try:
+        instrument.count("mpd_commands")
+        with instrument.timer("mpd_listall"):
+            unlisted = [entry["file"] for entry in client.listall()
+                        if "file" in entry and entry["file"] not in listed and
+                        entry["file"] not in known]
+        instrument.count("mpd_commands", len(unlisted))
+        with instrument.timer("mpd_find"):
+            entries = [entry for song in unlisted
+                       for entry in client.find("file", song)]
+    finally:
+        close_connection(client)
+    instrument.count("songs_enumerated", len(entries))
+    songs = [(entry["file"],
+              int(dateutil.parser.parse(entry["last-modified"]).timestamp()))
+             for entry in entries]
+    yield from sorted(songs, key=lambda song: song[1])
+
+
+def iter_changed(conn, mpd_root, songs, complete=True, use_hash=False):
+    """
+    Compare songs from the library with the manifest of analyzed files, and
+    update the db accordingly, by chunks of songs: renamed files (detected
+    using content hashes) keep their features and cached distances, and
+    changed files are deleted to be analyzed again. When all the songs have
+    been enumerated, removed files are deleted.
+
+    Params:
+        - conn: An SQLite connection to the blissify db.
+        - mpd_root: Root folder of the MPD library.
+        - songs: An iterable of (song, mtime) tuples from the library.
+        - complete: Whether songs enumerates the whole library, meaning that
+        files missing from it have been removed.
+        - use_hash: Whether to hash new files to detect renamed files.
+    Returns: A generator of the (song, mtime) tuples to analyze, in the order
+    of songs.
+    """
+    songs = iter(songs)
+    nb_new, nb_changed, nb_renamed = 0, 0, 0
+    if complete:
+        conn.execute("DROP TABLE IF EXISTS temp.scanned")
+        conn.execute(_SCANNED_SCHEMA)
+    while True:
+        chunk = list(itertools.islice(songs, _PAGE_SIZE))
+        if not chunk:
+            break
+        instrument.count("songs_scanned", len(chunk))
+        if complete:
+            with conn:
+                conn.executemany(_INSERT_SCANNED_QUERY,
+                                 ((song,) for song, _ in chunk))
+        if not schema.has_table(conn, "manifest"):
+            # Tables are created by blissify on first run
+            nb_new += len(chunk)
+            yield from chunk
+            continue
+        # Files are read before opening the transaction, not to lock the db
+        # while hashing them
+        pending, changed, renamed, recorded = [], [], {}, []
+        for song, mtime in chunk:
+            entry = conn.execute(_MANIFEST_QUERY, (song,)).fetchone()
+            if entry is None:
+                if (conn.execute(_SONG_ID_QUERY, (song,)).fetchone() or
+                        conn.execute(_ERROR_ID_QUERY, (song,)).fetchone()):
+                    # Analyzed before the manifest was introduced
+                    recorded.append((song, mtime))
+                    continue
+                old_song = None
+                if use_hash:
+                    old_song = find_renamed(conn, mpd_root, song, renamed)
+                if old_song is None:
+                    pending.append((song, mtime))
+                else:
+                    renamed[old_song] = (song, mtime)
+            elif (entry["mtime"] != mtime or
+                  entry["size"] != file_size(mpd_root, song)):
+                changed.append(song)
+                pending.append((song, mtime))
+            elif use_hash and entry["hash"] is None:
+                # Store missing hash of an unchanged file
+                recorded.append((song, mtime))
+        rows = manifest_rows(mpd_root, recorded, use_hash)
+        with instrument.timer("db_write"), conn:
+            for old_song, (song, mtime) in renamed.items():
+                conn.execute(_RENAME_SONG_QUERY, (song, old_song))
+                conn.execute(_RENAME_ERROR_QUERY, (song, old_song))
+                conn.execute(_RENAME_MANIFEST_QUERY, (song, mtime, old_song))
+                conn.execute(_RENAME_RETRIES_QUERY, (song, old_song))
+            for song in changed:
+                delete_song(conn, song)
+            conn.executemany(_INSERT_MANIFEST_QUERY, rows)
+        instrument.count("db_rows_written", len(rows) + len(renamed))
+        instrument.count("songs_deleted", len(changed))
+        nb_new += len(pending) - len(changed)
+        nb_changed += len(changed)
+        nb_renamed += len(renamed)
+        yield from pending
+
+    nb_removed = 0
+    if complete and schema.has_table(conn, "manifest"):
+        removed = [row["filename"]
+                   for row in conn.execute(_REMOVED_QUERY)]
+        nb_removed = len(removed)
+        with instrument.timer("db_write"), conn:
+            for song in removed:
+                delete_song(conn, song)
+        instrument.count("songs_deleted", nb_removed)
+    logging.info("%d new, %d changed, %d renamed and %d removed files." %
+                 (nb_new, nb_changed, nb_renamed, nb_removed))
+
+
+def find_renamed(conn, mpd_root, song, renamed):
+    """
+    Look for a removed file with the same content hash as a new song.
+
+    Params:
+        - conn: An SQLite connection to the blissify db.
+        - mpd_root: Root folder of the MPD library.
+        - song: The new song.
+        - renamed: Removed files already matched with another song.
+    Returns: The removed file, or None.
+    """
+    song_hash = file_hash(mpd_root, song)
+    if song_hash is None:
+        return None
+    for row in conn.execute(_MANIFEST_HASH_QUERY, (song_hash,)).fetchall():
+        old_song = row["filename"]
+        if (old_song not in renamed and
+                not os.path.exists(os.path.join(mpd_root, old_song))):
+            return old_song
+    return None
+
+
+def delete_song(conn, song):
+    """
+    Delete a song from the db, along with its cached distances.
+    """
+    conn.execute(_DELETE_SONG_QUERY, (song,))
+    conn.execute(_DELETE_ERROR_QUERY, (song,))
+    conn.execute(_DELETE_MANIFEST_QUERY, (song,))
+    conn.execute(_DELETE_RETRIES_QUERY, (song,))
+
+
+def manifest_rows(mpd_root, songs, use_hash=False):
+    """
+    Returns: The manifest rows of some (song, mtime) tuples.
+    """
+    return [(song, file_size(mpd_root, song), mtime,
+             file_hash(mpd_root, song) if use_hash else None)
+            for song, mtime in songs]
+
+
+def record_manifest(conn, mpd_root, songs, use_hash=False):
+    """
+    Store analyzed files in the manifest.
+
+    Params:
+        - conn: An SQLite connection to the blissify db.
+        - mpd_root: Root folder of the MPD library.
+        - songs: List of analyzed (song, mtime) tuples.
+        - use_hash: Whether to store content hashes of the files.
+    """
+    rows = manifest_rows(mpd_root, songs, use_hash)
+    with instrument.timer("db_write"), conn:
+        conn.executemany(_INSERT_MANIFEST_QUERY, rows)
+    instrument.count("db_rows_written", len(rows))
+
+
+def read_latest_mtime():
+    """
+    Returns: The latest modification timestamp of analyzed songs, or None if
+    no scan was done yet.
+    """
     try:
         with open(os.path.join(_BLISSIFY_DATA_HOME, "latest_mtime.txt"),
                   "r") as fh:
-            latest_mtime = int(str(fh.read()))
+            return int(str(fh.read()))
     except FileNotFoundError:
-        pass
+        return None
 
-    for song in all_songs:
-        last_modified = client.find("file", song)[0]["last-modified"]
-        last_modified = int(dateutil.parser.parse(last_modified).timestamp())
-        if last_modified > latest_mtime:
-            latest_mtime = last_modified
-    with open(os.path.join(_BLISSIFY_DATA_HOME, "latest_mtime.txt"), "w") as fh:
 
+def write_latest_mtime(latest_mtime):
+    """
+    Update the latest modification timestamp of analyzed songs, atomically.
+
+    Params:
+        - latest_mtime: A timestamp such that all the songs modified before
+        it have been analyzed.
+    """
+    path = os.path.join(_BLISSIFY_DATA_HOME, "latest_mtime.txt")
+    with open("%s.tmp" % (path,), "w") as fh:
         fh.write(str(latest_mtime))
-    close_connection(client)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace("%s.tmp" % (path,), path)
 
-def rescan_errored(mpd_root):
+
+def run_blissify(mpd_root, songs):
     """
-    Rescan only errored files.
+    Run blissify on some songs, retrying if it fails (e.g. when the db stays
+    locked by other blissify runs for longer than their busy timeout).
+
+    Returns: The time spent in blissify, in seconds.
+    """
+    start = time.monotonic()
+    for attempt in range(1, _RETRIES + 1):
+        instrument.count("blissify_runs")
+        try:
+            with instrument.timer("blissify"):
+                subprocess.check_call(["blissify", mpd_root] + songs)
+            break
+        except subprocess.CalledProcessError:
+            if attempt == _RETRIES:
+                raise
+            logging.warning("blissify failed, retrying (attempt %d/%d)." %
+                            (attempt + 1, _RETRIES))
+            time.sleep(2 ** attempt)
+    return time.monotonic() - start
+
+
+def analyze(mpd_root, songs, jobs=_JOBS, checkpoint=None):
+    """
+    Run blissify on songs, by batches, with several processes in parallel.
+    Batches are sized from the measured analysis time per file, and songs
+    are only consumed when a process is available to analyze them.
+
+    Params:
+        - mpd_root: Root folder of the MPD library.
+        - songs: An iterable of (song, mtime) tuples to analyze, with songs
+        relative to mpd_root.
+        - jobs: Number of blissify processes to run in parallel.
+        - checkpoint: An optional function called after each analyzed batch,
+        with the batch and the lowest mtime of the songs not analyzed yet
+        (None once all the songs were consumed and analyzed).
+    Returns: The number of analyzed songs.
+    """
+    songs = iter(songs)
+    exhausted = False
+    # Songs not consumed yet are modified after the last consumed one
+    last_mtime = None
+    nb_analyzed = 0
+    time_per_song = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        running = {}
+        while not exhausted or running:
+            # Keep all the workers busy
+            while not exhausted and len(running) < jobs:
+                if time_per_song is None:
+                    batch_size = _BATCH_SIZE
+                else:
+                    batch_size = int(_BATCH_DURATION / max(time_per_song, 1e-3))
+                    batch_size = max(_MIN_BATCH_SIZE,
+                                     min(_MAX_BATCH_SIZE, batch_size))
+                batch = list(itertools.islice(songs, batch_size))
+                exhausted = len(batch) < batch_size
+                if batch:
+                    last_mtime = batch[-1][1]
+                    running[pool.submit(run_blissify, mpd_root,
+                                        [song for song, _ in batch])] = batch
+            if not running:
+                break
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                batch = running.pop(future)
+                nb_analyzed += len(batch)
+                instrument.count("songs_analyzed", len(batch))
+                # Exponential moving average of the time per song
+                batch_time_per_song = future.result() / len(batch)
+                if time_per_song is None:
+                    time_per_song = batch_time_per_song
+                else:
+                    time_per_song = (0.7 * time_per_song +
+                                     0.3 * batch_time_per_song)
+                logging.info("Analyzed %d songs (%.2fs per song)." %
+                             (nb_analyzed, batch_time_per_song))
+                if checkpoint is not None:
+                    pending = [mtime for other in running.values()
+                               for _, mtime in other]
+                    if not exhausted:
+                        pending.append(last_mtime)
+                    checkpoint(batch, min(pending, default=None))
+    return nb_analyzed
+
+
+def scan(conn, mpd_root, library, jobs=_JOBS, complete=True, use_hash=False,
+         use_replica=False):
+    """
+    Analyze the new and changed songs of the library as they are enumerated.
+    The manifest and the latest mtime are updated after each analyzed batch,
+    so that an interrupted scan resumes where it stopped.
+
+    Params:
+        - conn: An SQLite connection to the blissify db.
+        - mpd_root: Root folder of the MPD library.
+        - library: A Library enumerating the songs to scan.
+        - jobs: Number of blissify processes to run in parallel.
+        - complete: Whether library enumerates the whole library. Otherwise,
+        the songs of the library missing from the db are scanned as well.
+        - use_hash: Whether to hash files to detect renamed files.
+        - use_replica: Whether to publish the replica of the db during long
+        scans.
+    Returns: The number of analyzed songs.
+    """
+    last_published = time.monotonic()
+
+    def checkpoint(batch, pending_mtime):
+        nonlocal last_published
+        # Tables may have been created by blissify
+        schema.migrate(conn)
+        record_manifest(conn, mpd_root, batch, use_hash)
+        # Songs are enumerated by ascending mtime
+        write_latest_mtime(library.mtime if pending_mtime is None
+                           else pending_mtime)
+        if (use_replica and
+                time.monotonic() - last_published > _REPLICA_INTERVAL):
+            publish_replica(conn)
+            last_published = time.monotonic()
+
+    songs = library if complete else iter_unlisted(conn, library)
+    songs = iter_changed(conn, mpd_root, songs, complete, use_hash)
+    nb_analyzed = analyze(mpd_root, songs, jobs, checkpoint)
+    schema.migrate(conn)
+    if library.mtime is not None:
+        write_latest_mtime(library.mtime)
+    return nb_analyzed
+
+
+def publish_replica(conn):
+    """
+    Publish the replica of the db read by `client.py --replica`.
+    """
+    replica.publish(conn, os.path.join(_BLISSIFY_DATA_HOME, "replica.sqlite3"))
+
+
+def full_rescan(mpd_root, jobs=_JOBS, purge=False, use_hash=False,
+                use_replica=False):
+    """
+    Perform a full rescan of the MPD library. Only new and changed files are
+    analyzed, unless purge is set.
     """
     # Connect to db
     db_path = os.path.join(_BLISSIFY_DATA_HOME, "db.sqlite3")
     logging.debug("Using DB path: %s." % (db_path,))
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    conn.execute('pragma foreign_keys=ON')
-    cur = conn.cursor()
-    # Get errored files
-    cur.execute("SELECT filename FROM errors")
-    errors = cur.fetchall()
-    # Rerun blissify on them
-    if errors is not None:
-       subprocess.check_call(["blissify", mpd_root] + errors)
+    # Backup database
+    backup_db_path = "%s.old" % (db_path,)
+    try:
+        shutil.copy(db_path, "%s" % (backup_db_path,))
+        print(("DB is saved as %s. You can remove this file manually " +
+               "at the end of the proces if you want.") % (backup_db_path,))
+    except FileNotFoundError:
+        pass
+    conn = init_db_connection()
+    if purge:
+        # Empty database
+        try:
+            with conn:
+                for purge_query in _PURGE_QUERIES:
+                    conn.execute(purge_query)
+        except sqlite3.OperationalError:
+            # Tables are created by blissify on first run
+            pass
+
+    # Blissify new and changed songs, while enumerating them from MPD
+    scan(conn, mpd_root, Library(), jobs, True, use_hash, use_replica)
+    if use_replica:
+        publish_replica(conn)
+    conn.close()
+
+def due_errors(conn, now, limit=_MAX_ERRORS_PER_PASS):
+    """
+    Returns: The errored files to retry, never retried ones first.
+    """
+    return [row["filename"] for row in conn.execute(
+        _DUE_ERRORS_QUERY, (_MAX_ERROR_ATTEMPTS, now, limit))]
+
+
+def retry_errors(mpd_root, songs):
+    """
+    Run blissify once on some errored songs.
+
+    Returns: A (returncode, stderr) tuple.
+    """
+    instrument.count("blissify_runs")
+    with instrument.timer("blissify"):
+        process = subprocess.run(["blissify", mpd_root] + songs,
+                                 stderr=subprocess.PIPE,
+                                 universal_newlines=True)
+    logging.debug(process.stderr)
+    return process.returncode, process.stderr
+
+
+def record_retries(conn, songs, returncode, stderr, now):
+    """
+    Store the outcome of a retry of some errored songs: fixed songs are
+    removed from the errors, and the next retry of the others is scheduled.
+
+    Returns: The number of fixed songs.
+    """
+    nb_fixed = 0
+    instrument.count("db_rows_written", len(songs))
+    with instrument.timer("db_write"), conn:
+        for song in songs:
+            if conn.execute(_SONG_ID_QUERY, (song,)).fetchone():
+                nb_fixed += 1
+                conn.execute(_DELETE_ERROR_QUERY, (song,))
+                conn.execute(_DELETE_RETRIES_QUERY, (song,))
+                continue
+            errors = [line for line in stderr.splitlines() if song in line]
+            if errors:
+                last_error = errors[-1]
+            elif returncode != 0:
+                last_error = "blissify exited with status %d." % (returncode,)
+            else:
+                last_error = "Analysis failed."
+            row = conn.execute(_RETRY_ATTEMPTS_QUERY, (song,)).fetchone()
+            attempts = (row["attempts"] if row is not None else 0) + 1
+            conn.execute(
+                _INSERT_RETRY_QUERY,
+                (song, attempts, last_error,
+                 now + _ERROR_RETRY_DELAY * 2 ** (attempts - 1)))
+            if attempts >= _MAX_ERROR_ATTEMPTS:
+                logging.warning("Skipping %s from now on: %s" %
+                                (song, last_error))
+    return nb_fixed
 
 
-def update_db(mpd_root):
+def rescan_errored(mpd_root, jobs=_JOBS, use_replica=False):
     """
-    Update the blissify db taking newly added songs in MPD library.
+    Rescan errored files which are due for a retry, by batches. Files of a
+    batch which crashed blissify are retried one by one, so that a bad file
+    does not make the others fail.
     """
+    conn = init_db_connection()
+    if not schema.has_table(conn, "error_retries"):
+        # Tables are created by blissify on first run
+        conn.close()
+        return
+    now = int(time.time())
+    songs = due_errors(conn, now)
+    batches = [songs[i:i + _ERRORS_BATCH_SIZE]
+               for i in range(0, len(songs), _ERRORS_BATCH_SIZE)]
+    nb_fixed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        running = {pool.submit(retry_errors, mpd_root, batch): batch
+                   for batch in batches}
+        while running:
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                batch = running.pop(future)
+                returncode, stderr = future.result()
+                if returncode != 0 and len(batch) > 1:
+                    # Isolate the files of the batch
+                    for song in batch:
+                        running[pool.submit(retry_errors, mpd_root,
+                                            [song])] = [song]
+                    continue
+                nb_fixed += record_retries(conn, batch, returncode, stderr,
+                                           now)
+    logging.info("Fixed %d of %d errored files." % (nb_fixed, len(songs)))
+    if use_replica and (nb_fixed or not os.path.exists(
+            os.path.join(_BLISSIFY_DATA_HOME, "replica.sqlite3"))):
+        publish_replica(conn)
+    conn.close()
+
+
+def remove_missing(conn, mpd_root):
+    """
+    Delete the songs whose file was removed from the library, along with
+    their cached distances.
+
+    Returns: The number of removed songs.
+    """
+    if not schema.has_table(conn, "songs"):
+        return 0
+    missing = [
+        row["filename"] for row in conn.execute(_FILENAMES_QUERY).fetchall()
+        if not os.path.exists(os.path.join(mpd_root, row["filename"]))
+    ]
+    if not missing:
+        return 0
+    # Double check with MPD, in case mpd_root is not mounted
     client = init_connection()
-    latest_mtime = 0
     try:
-        with open(os.path.join(_BLISSIFY_DATA_HOME, "latest_mtime.txt"), "r") as fh:
-            latest_mtime = int(fh.read())
-    except FileNotFoundError:
+        instrument.count("mpd_commands", len(missing))
+        with instrument.timer("mpd_find"):
+            missing = [song for song in missing
+                       if not client.find("file", song)]
+    finally:
+        close_connection(client)
+    with instrument.timer("db_write"), conn:
+        for song in missing:
+            delete_song(conn, song)
+    instrument.count("songs_deleted", len(missing))
+    logging.info("Removed %d songs." % (len(missing),))
+    return len(missing)
+
+
+def update_db(mpd_root, jobs=_JOBS, use_hash=False, use_replica=False):
+    """
+    Update the blissify db taking newly added and removed songs in MPD
+    library.
+    """
+    latest_mtime = read_latest_mtime()
+    if latest_mtime is None:
         logging.error("latest_mtime.txt file not found. Please call --full-rescan before --update.")
         return
-    songs = [x["file"] for x in client.find("modified-since", latest_mtime)]
-    subprocess.check_call(["blissify", mpd_root] + songs)
-    for song in songs:
-        close_connection(client)
-        client = init_connection()
-        last_modified = client.find("file", song)[0]["last-modified"]
-        last_modified = int(dateutil.parser.parse(last_modified).timestamp())
-        if last_modified > latest_mtime:
-            latest_mtime = last_modified
-    with open(os.path.join(_BLISSIFY_DATA_HOME, "latest_mtime.txt"), "w") as fh:
-        fh.write(str(latest_mtime))
-    close_connection(client)
+    conn = init_db_connection()
+    nb_analyzed = scan(conn, mpd_root, Library(latest_mtime), jobs, False,
+                       use_hash, use_replica)
+    # Removed once renamed files were matched with their new path
+    nb_removed = remove_missing(conn, mpd_root)
+    if nb_removed or nb_analyzed:
+        update_cache()
+    # Published once the caches are updated as well
+    if use_replica and (nb_removed or nb_analyzed or not os.path.exists(
+            os.path.join(_BLISSIFY_DATA_HOME, "replica.sqlite3"))):
+        publish_replica(conn)
+    conn.close()
 
 
-def listen(mpd_root):
+def update_cache():
     """
-    Listen for additions in MPD library using MPD IDLE and handle them
-    immediately.
+    Update the distances cache and neighbours lists built by
+    `build_cache.py` with the added and removed songs, if the script is
+    available.
+    """
+    if os.path.exists(_BUILD_CACHE):
+        with instrument.timer("build_cache"):
+            subprocess.check_call([sys.executable, _BUILD_CACHE,
+                                   "--incremental"])
+
+
+def coalesce_updates(events, mpd_root, jobs=_JOBS, use_hash=False,
+                     use_replica=False):
+    """
+    Update the blissify db after MPD database events, merging bursts of
+    events into a single update.
+
+    Params:
+        - events: A queue.Queue receiving the time of each event, and None to
+        stop.
+        - mpd_root: Root folder of the MPD library.
+        - jobs: Number of blissify processes to run in parallel.
+        - use_hash: Whether to hash files to detect renamed files.
+        - use_replica: Whether to publish the replica of the db after each
+        update.
     """
-    client = init_connection()
     while True:
+        first_event = events.get()
+        if first_event is None:
+            return
+        # Wait for the end of the burst, events queued during the previous
+        # update being merged right away
+        deadline = first_event + _MAX_DEBOUNCE_DELAY
+        while True:
+            timeout = min(_DEBOUNCE_DELAY, deadline - time.monotonic())
+            try:
+                if events.get(timeout=max(timeout, 0)) is None:
+                    return
+            except queue.Empty:
+                break
         try:
+            update_db(mpd_root, jobs, use_hash, use_replica)
+        except (subprocess.CalledProcessError, sqlite3.Error, MPDError,
+                OSError):
+            # Songs will be scanned again on next update
+            logging.exception("Update failed.")
+
+
+def listen(mpd_root, jobs=_JOBS, use_hash=False, use_replica=False):
+    """
+    Listen for changes in MPD library using MPD IDLE and handle them in the
+    background, so that no event is missed during an update.
+    """
+    events = queue.Queue()
+    updater = threading.Thread(target=coalesce_updates,
+                               args=(events, mpd_root, jobs, use_hash,
+                                     use_replica))
+    updater.start()
+    client = init_connection()
+    try:
+        while True:
+            instrument.count("mpd_commands")
             client.idle("database")
-        except KeyboardInterrupt:
-            break
-        update_db(mpd_root)
-    close_connection(client)
+            events.put(time.monotonic())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        events.put(None)
+        updater.join()
+        close_connection(client)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("mpd_root", help="Root folder of your MPD library.")
+    parser.add_argument("--jobs", help="Number of blissify processes to run in parallel.",
+                        type=int, default=_JOBS)
+    parser.add_argument("--purge", help="Purge the db before a full rescan, to analyze all the files again.",
+                        action="store_true", default=False)
+    parser.add_argument("--hash", help="Hash files content, to detect renamed files.",
+                        action="store_true", default=False)
+    parser.add_argument("--replica", help="Publish a read-only replica of the db for client.py --replica after the changes.",
+                        action="store_true", default=False)
 
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--full-rescan", help="Scan the whole library.",
@@ -184,16 +895,22 @@ if __name__ == "__main__":
     group.add_argument("--listen",
                        help="Listen for MPD IDLE signals to do live scanning.",
                        action="store_true", default=False)
+    parser.add_argument("--stats", help="Write a JSON summary of timers and counters to FILE ('-' for stderr) on exit.",
+                        metavar="FILE")
+    parser.add_argument("--profile", help="Dump cProfile stats of the run to FILE.",
+                        metavar="FILE")
 
     args = parser.parse_args()
+    instrument.enable(args.stats, args.profile)
 
     if args.full_rescan:
-        full_rescan(args.mpd_root)
+        full_rescan(args.mpd_root, args.jobs, args.purge, args.hash,
+                    args.replica)
     elif args.rescan_errored:
-        rescan_errored(args.mpd_root)
+        rescan_errored(args.mpd_root, args.jobs, args.replica)
     elif args.update:
-        update_db(args.mpd_root)
+        update_db(args.mpd_root, args.jobs, args.hash, args.replica)
     elif args.listen:
-        listen(args.mpd_root)
+        listen(args.mpd_root, args.jobs, args.hash, args.replica)
     else:
         sys.exit()
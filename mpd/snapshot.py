@@ -0,0 +1,287 @@
+"""
+Compact binary snapshot of the normalised song features, memory-mapped by
+`client.py` instead of loading the songs from the db at each startup.
+
+The snapshot file stores, in native byte order:
+    - a header (magic, db identifier, db generation, songs and strings
+    counts, size of the strings blob),
+    - the (n, 4) float32 matrix of the normalised features, and the n
+    float32 norms,
+    - the n int64 song ids, sorted,
+    - for each song, the indices of its filename and album (-1 if none) in
+    the string table,
+    - the string table: the offsets of the distinct strings in the blob, and
+    the UTF-8 blob itself.
+
+A snapshot is stale as soon as the generation counter stored in the
+`metadata` table (bumped by triggers, see `schema.init_generation`) differs
+from its own, in which case it is exported again. Each db (the db and its
+replica) has its own snapshot file, next to it.
+"""
+import array
+import bisect
+import logging
+import mmap
+import os
+import struct
+
+import instrument
+import normalisation
+import schema
+
+_MAGIC = b"BLISSNP1"
+# Magic, db identifier, generation, songs count, strings count, blob size
+_HEADER = struct.Struct("=8s16sQQQQ")
+
+_GENERATION_QUERY = schema.query(
+    "SELECT name, value FROM metadata WHERE name IN ('db_id', 'generation')",
+    ["metadata"])
+_SONGS_QUERY = schema.query(
+    "SELECT id, tempo, amplitude, frequency, attack, norm, filename, album FROM song_features ORDER BY id",
+    ["features"])
+
+
+def _align(offset):
+    """
+    Returns: The offset rounded up to a multiple of 8 bytes.
+    """
+    return (offset + 7) & ~7
+
+
+def _layout(count, nb_strings):
+    """
+    Returns: The offsets of the sections of a snapshot, as a (features, norms,
+    ids, filenames, albums, string offsets, blob) tuple.
+    """
+    features = _align(_HEADER.size)
+    norms = features + 16 * count
+    ids = _align(norms + 4 * count)
+    filenames = ids + 8 * count
+    albums = filenames + 4 * count
+    offsets = _align(albums + 4 * count)
+    blob = offsets + 8 * (nb_strings + 1)
+    return features, norms, ids, filenames, albums, offsets, blob
+
+
+def default_path(conn):
+    """
+    Returns: The path of the snapshot of the db of a connection, next to the
+    db file: `snapshot.bin` for `db.sqlite3`, and `<name>.snapshot.bin` for
+    other dbs (e.g. `replica.snapshot.bin` for the replica).
+    """
+    db_path = conn.execute("PRAGMA database_list").fetchone()[2]
+    name = os.path.splitext(os.path.basename(db_path))[0]
+    return os.path.join(os.path.dirname(db_path),
+                        "snapshot.bin" if name == "db" else
+                        "%s.snapshot.bin" % (name,))
+
+
+def get_generation(conn):
+    """
+    Returns: A (db identifier, generation) tuple, or None if the db has no
+    generation counter yet.
+    """
+    rows = dict(conn.execute(_GENERATION_QUERY).fetchall())
+    if len(rows) < 2:
+        return None
+    return bytes.fromhex(rows["db_id"]), int(rows["generation"])
+
+
+class Snapshot:
+    """
+    A read-only, memory-mapped snapshot of the song features.
+
+    Songs are indexed by their position in the snapshot, sorted by id. The
+    features, norms and ids attributes are memoryviews over the mapped file,
+    and can be wrapped without copy with `numpy.frombuffer`.
+    """
+    def __init__(self, path):
+        with open(path, "rb") as fh:
+            self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.db_id, self.generation, count, nb_strings,
+         blob_size) = _HEADER.unpack_from(self._mmap)
+        (features, norms, ids, filenames, albums, offsets,
+         blob) = _layout(count, nb_strings)
+        if magic != _MAGIC or len(self._mmap) != blob + blob_size:
+            self._mmap.close()
+            raise ValueError("Invalid snapshot file %s." % (path,))
+        self.count = count
+        self._view = view = memoryview(self._mmap)
+        self.features = view[features:norms].cast("f")
+        self.norms = view[norms:norms + 4 * count].cast("f")
+        self.ids = view[ids:filenames].cast("q")
+        self._filenames = view[filenames:albums].cast("I")
+        self._albums = view[albums:albums + 4 * count].cast("i")
+        self._offsets = view[offsets:blob].cast("Q")
+        self._blob = blob
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        """
+        Returns: The song at some index, as a dict with the columns of the
+        song_features view.
+        """
+        if not 0 <= index < self.count:
+            raise IndexError("Snapshot index out of range.")
+        song = dict(zip(normalisation.FEATURES,
+                        self.features[4 * index:4 * index + 4]))
+        song["id"] = self.ids[index]
+        song["norm"] = self.norms[index]
+        song["filename"] = self.filename(index)
+        song["album"] = self.album(index)
+        return song
+
+    def _string(self, string_index):
+        start = self._blob + self._offsets[string_index]
+        end = self._blob + self._offsets[string_index + 1]
+        return self._mmap[start:end].decode("utf-8")
+
+    def filename(self, index):
+        """
+        Returns: The filename of the song at some index.
+        """
+        return self._string(self._filenames[index])
+
+    def album(self, index):
+        """
+        Returns: The album of the song at some index, None if it has none.
+        """
+        string_index = self._albums[index]
+        return self._string(string_index) if string_index >= 0 else None
+
+    def index(self, song_id):
+        """
+        Returns: The index of a song from its id, None if it is not in the
+        snapshot.
+        """
+        index = bisect.bisect_left(self.ids, song_id)
+        if index < self.count and self.ids[index] == song_id:
+            return index
+        return None
+
+    def points(self):
+        """
+        Returns: The list of the features tuples of the songs.
+        """
+        flat = self.features.tolist()
+        return list(zip(flat[0::4], flat[1::4], flat[2::4], flat[3::4]))
+
+    def close(self):
+        """
+        Unmap the snapshot file. Songs returned before stay valid.
+        """
+        for view in (self.features, self.norms, self.ids, self._filenames,
+                     self._albums, self._offsets, self._view):
+            view.release()
+        self._mmap.close()
+
+
+def _write(conn, path):
+    """
+    Write a snapshot of the song features of the db to a temporary file next
+    to path.
+
+    Returns: A (temporary path, (db identifier, generation)) tuple.
+    """
+    features = array.array("f")
+    norms = array.array("f")
+    ids = array.array("q")
+    filenames = array.array("I")
+    albums = array.array("i")
+    strings = {}
+    # Read the generation and the songs in the same read transaction
+    with conn:
+        conn.execute("BEGIN")
+        generation = get_generation(conn)
+        for song in conn.execute(_SONGS_QUERY):
+            features.extend(song[1:5])
+            norms.append(song[5])
+            ids.append(song[0])
+            filenames.append(strings.setdefault(song[6], len(strings)))
+            albums.append(-1 if song[7] is None else
+                          strings.setdefault(song[7], len(strings)))
+    offsets = array.array("Q", [0])
+    blob = []
+    for string in strings:
+        blob.append(string.encode("utf-8"))
+        offsets.append(offsets[-1] + len(blob[-1]))
+    blob = b"".join(blob)
+    instrument.count("snapshot_songs_exported", len(ids))
+
+    logging.info("Exporting snapshot of %d songs (generation %d)." %
+                 (len(ids), generation[1]))
+    layout = _layout(len(ids), len(strings))
+    sections = [features, norms, ids, filenames, albums, offsets, blob]
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as fh:
+        fh.write(_HEADER.pack(_MAGIC, generation[0], generation[1], len(ids),
+                              len(strings), len(blob)))
+        for offset, section in zip(layout, sections):
+            fh.write(b"\0" * (offset - fh.tell()))
+            fh.write(section)
+        fh.flush()
+        os.fsync(fh.fileno())
+    return tmp_path, generation
+
+
+def export(conn, path):
+    """
+    Write a snapshot of the song features of the db, atomically.
+
+    Returns: The (db identifier, generation) tuple of the snapshot.
+    """
+    tmp_path, generation = _write(conn, path)
+    os.replace(tmp_path, path)
+    return generation
+
+
+def refresh(conn, path):
+    """
+    Export the snapshot of the song features if it is missing or stale.
+
+    Returns: Whether the snapshot was exported.
+    """
+    generation = get_generation(conn)
+    try:
+        with open(path, "rb") as fh:
+            header = fh.read(_HEADER.size)
+        if (len(header) == _HEADER.size and
+                _HEADER.unpack(header)[:3] == (_MAGIC,) + generation):
+            return False
+    except FileNotFoundError:
+        pass
+    with instrument.timer("snapshot_export"):
+        export(conn, path)
+    return True
+
+
+def load(conn, path=None):
+    """
+    Map the snapshot of the song features, exporting it first if it is
+    missing, stale or from another db.
+
+    Params:
+        - conn: An SQLite connection to the db.
+        - path: Path of the snapshot, defaults to the one of the db (see
+        `default_path`).
+    Returns: A Snapshot, of the db identifier and generation of the db.
+    """
+    if path is None:
+        path = default_path(conn)
+    generation = get_generation(conn)
+    try:
+        songs = Snapshot(path)
+        # Checked once mapped, as other processes may replace the file
+        if (songs.db_id, songs.generation) == generation:
+            return songs
+        songs.close()
+    except (FileNotFoundError, ValueError, struct.error):
+        pass
+    with instrument.timer("snapshot_export"):
+        tmp_path, _ = _write(conn, path)
+    # Mapped before being renamed, so that it cannot be replaced in between
+    songs = Snapshot(tmp_path)
+    os.replace(tmp_path, path)
+    return songs
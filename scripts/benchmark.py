@@ -0,0 +1,578 @@
+#!/usr/bin/env python3
+"""
+This is a script to benchmark the scripts of this repo on synthetic
+libraries, offline.
+
+For each library size, it generates a blissify db (with the schema created by
+`src/analysis.c`) and the matching music folder, serves the library with a
+local fake MPD server, and times:
+    - `build_cache.py` (neighbours lists, and full distances cache on small
+    libraries),
+    - `client.py` song-based (greedy and planned) and album-based mixes
+    (`main_single` and `main_album`),
+    - `server.py --full-rescan` of the already analyzed library (only
+    recording the songs in the manifest), `server.py --full-rescan --purge`
+    (analyzing all the songs again) and `server.py --update`, after adding
+    and removing some songs, with a stub `blissify` inserting synthetic
+    features.
+
+Each workload runs in its own process. The report, written as JSON, gives for
+each of them its duration, its throughput, the peak RSS of its process tree,
+the number of MPD round-trips, and the timers and counters of its phases
+(from its `--stats` summary).
+
+Run `python3 benchmark.py --help` for more infos on how to use.
+"""
+import argparse
+import bisect
+import collections
+import datetime
+import importlib.metadata
+import json
+import logging
+import os
+import platform
+import random
+import shlex
+import shutil
+import socketserver
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+logging.basicConfig(level=logging.INFO)
+
+if "XDG_DATA_HOME" in os.environ:
+    _BLISSIFY_DATA_HOME = os.path.expandvars("$XDG_DATA_HOME/blissify")
+else:
+    _BLISSIFY_DATA_HOME = os.path.expanduser("~/.local/share/blissify")
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+_BUILD_CACHE = os.path.join(_ROOT, "scripts", "build_cache.py")
+_CLIENT = os.path.join(_ROOT, "mpd", "client.py")
+_SERVER = os.path.join(_ROOT, "mpd", "server.py")
+
+_SIZES = [1000, 10000, 100000]
+_QUEUE_LENGTH = 20
+_TOP_K = 10
+# Full distances caches grow quadratically, they are only built for the
+# libraries up to this size
+_MAX_DISTANCES_SIZE = 2000
+# Share of the library added and removed before the update
+_CHANGES = 0.01
+# Schema created by blissify, from src/analysis.c
+_BLISSIFY_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS songs( \
+        id INTEGER PRIMARY KEY, \
+        tempo REAL, \
+        amplitude REAL, \
+        frequency REAL, \
+        attack REAL, \
+        filename TEXT UNIQUE, \
+        album TEXT)",
+    "CREATE TABLE IF NOT EXISTS distances( \
+        song1 INTEGER, \
+        song2 INTEGER, \
+        distance REAL, \
+        similarity REAL, \
+        FOREIGN KEY(song1) REFERENCES songs(id) ON DELETE CASCADE, \
+        FOREIGN KEY(song2) REFERENCES songs(id) ON DELETE CASCADE, \
+        UNIQUE (song1, song2))",
+    "CREATE TABLE IF NOT EXISTS errors( \
+        id INTEGER PRIMARY KEY, \
+        filename TEXT UNIQUE)",
+    "CREATE TABLE IF NOT EXISTS metadata( \
+        name TEXT UNIQUE, \
+        value TEXT)",
+]
+_BLISSIFY_VERSION = "0.1"
+# Spread of the features between albums, songs of an album being closer
+_FEATURES_SCALES = [3.0, 0.5, 2.0, 1.0]
+_ALBUM_SPREAD = 0.4
+# Modification time of the first album of the library, next ones being added
+# one hour apart
+_FIRST_MTIME = 1577836800
+
+
+def synthetic_features(filename):
+    """
+    Compute deterministic synthetic features for a song, close to those of the
+    other songs of its album.
+
+    Returns: A (tempo, amplitude, frequency, attack) tuple.
+    """
+    album_rng = random.Random(zlib.crc32(os.path.dirname(filename).encode()))
+    song_rng = random.Random(zlib.crc32(filename.encode()))
+    return tuple(
+        album_rng.gauss(0, scale) + song_rng.gauss(0, scale * _ALBUM_SPREAD)
+        for scale in _FEATURES_SCALES)
+
+
+def album_size(rng):
+    """
+    Returns: A random number of songs for an album, mostly full-length
+    albums, along with EPs, singles and some long compilations.
+    """
+    return rng.choices([rng.randint(1, 3), rng.randint(4, 7),
+                        rng.randint(8, 14), rng.randint(15, 30)],
+                       weights=[10, 15, 65, 10])[0]
+
+
+def generate_songs(size, first_album=0, first_mtime=_FIRST_MTIME, seed=0):
+    """
+    Generate the songs of a synthetic library, artists having a few albums.
+
+    Params:
+        - size: Number of songs.
+        - first_album: Number of the first album.
+        - first_mtime: Modification time of the first album.
+        - seed: Random seed.
+    Returns: A list of (filename, mtime) tuples.
+    """
+    rng = random.Random(seed)
+    songs = []
+    album = first_album
+    while len(songs) < size:
+        artist = "Artist %05d" % (album // 3,)
+        mtime = first_mtime + 3600 * (album - first_album)
+        for track in range(min(album_size(rng), size - len(songs))):
+            songs.append(("%s/Album %05d/%02d - Track.flac" %
+                          (artist, album, track + 1), mtime))
+        album += rng.randint(1, 2)
+    return songs
+
+
+def create_files(mpd_root, songs):
+    """
+    Create empty music files, with the modification times of the songs.
+    """
+    for song, mtime in songs:
+        path = os.path.join(mpd_root, song)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, "wb").close()
+        os.utime(path, (mtime, mtime))
+
+
+def create_db(db_path, songs):
+    """
+    Create a blissify db with the synthetic features of some songs.
+    """
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    for query in _BLISSIFY_SCHEMA:
+        conn.execute(query)
+    with conn:
+        conn.execute("INSERT INTO metadata(name, value) VALUES(?, ?)",
+                     ("version", _BLISSIFY_VERSION))
+        conn.executemany(
+            "INSERT INTO songs(tempo, amplitude, frequency, attack, filename, album) VALUES(?, ?, ?, ?, ?, ?)",
+            (synthetic_features(song) +
+             (song, os.path.basename(os.path.dirname(song)))
+             for song, _ in songs))
+    conn.close()
+
+
+def stub_blissify(base_path, filenames):
+    """
+    Stand-in for the blissify executable, inserting synthetic features in the
+    db for each song, in its own transaction, as blissify does.
+    """
+    os.makedirs(_BLISSIFY_DATA_HOME, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(_BLISSIFY_DATA_HOME, "db.sqlite3"),
+                           timeout=60)
+    conn.execute("PRAGMA foreign_keys = ON")
+    for query in _BLISSIFY_SCHEMA:
+        conn.execute(query)
+    for filename in filenames:
+        print("\nAdding new song to db: %s" % (filename,))
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT INTO songs(tempo, amplitude, frequency, attack, filename, album) VALUES(?, ?, ?, ?, ?, ?)",
+                    synthetic_features(filename) +
+                    (filename, os.path.basename(os.path.dirname(filename))))
+        except sqlite3.IntegrityError:
+            print("Error while parsing song: %s%s." % (base_path, filename),
+                  file=sys.stderr)
+            with conn:
+                conn.execute(
+                    "INSERT OR IGNORE INTO errors(filename) VALUES(?)",
+                    (filename,))
+    conn.close()
+    print("Done! :)")
+
+
+class FakeMPDHandler(socketserver.StreamRequestHandler):
+    """
+    Handler of a connection to the fake MPD server, counting round-trips.
+    """
+    def handle(self):
+        self.wfile.write(b"OK MPD 0.21.0\n")
+        self.server.count("connections")
+        for line in self.rfile:
+            args = shlex.split(line.decode("utf-8"))
+            if not args:
+                continue
+            self.server.count(args[0])
+            if args[0] == "close":
+                return
+            try:
+                lines = self.server.command(args)
+            except (KeyError, ValueError, IndexError):
+                self.wfile.write(("ACK [5@0] {%s} unknown command\n" %
+                                  (args[0],)).encode("utf-8"))
+                continue
+            self.wfile.write("".join("%s\n" % (response,)
+                                     for response in lines + ["OK"])
+                             .encode("utf-8"))
+
+
+class FakeMPD(socketserver.ThreadingTCPServer):
+    """
+    A local fake MPD server, serving a library from memory and implementing
+    the commands used by the scripts.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    commands = ["add", "clear", "close", "commands", "find", "listall",
+                "password", "ping", "playlist", "status"]
+
+    def __init__(self, songs):
+        super().__init__(("127.0.0.1", 0), FakeMPDHandler)
+        self.lock = threading.Lock()
+        self.playlist = []
+        self.counts = collections.Counter()
+        self.set_library(songs)
+
+    def set_library(self, songs):
+        """
+        Replace the library with some (filename, mtime) tuples.
+        """
+        with self.lock:
+            self.songs = sorted(songs, key=lambda song: (song[1], song[0]))
+            self.mtimes = [mtime for _, mtime in self.songs]
+            self.last_modified = {
+                song: datetime.datetime.fromtimestamp(
+                    mtime, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+                for song, mtime in self.songs}
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def reset_counts(self):
+        """
+        Returns: The counts of connections and commands since the last reset.
+        """
+        with self.lock:
+            counts = self.counts
+            self.counts = collections.Counter()
+        return counts
+
+    def command(self, args):
+        """
+        Run a command.
+
+        Returns: The lines of the response, without the final OK.
+        """
+        with self.lock:
+            return getattr(self, "_%s" % (args[0],))(*args[1:])
+
+    def _commands(self):
+        return ["command: %s" % (command,) for command in self.commands]
+
+    def _ping(self):
+        return []
+
+    def _password(self, password):
+        return []
+
+    def _status(self):
+        lines = ["volume: -1", "repeat: 0", "random: 0",
+                 "playlistlength: %d" % (len(self.playlist),), "state: stop"]
+        if self.playlist:
+            lines.append("song: %d" % (len(self.playlist) - 1,))
+        return lines
+
+    def _playlist(self):
+        return ["%d:file: %s" % (position, song)
+                for position, song in enumerate(self.playlist)]
+
+    def _add(self, song):
+        self.playlist.append(song)
+        return []
+
+    def _clear(self):
+        self.playlist = []
+        return []
+
+    def _listall(self):
+        return ["file: %s" % (song,) for song, _ in self.songs]
+
+    def _find(self, *args):
+        filters = dict(zip(args[::2], args[1::2]))
+        if "file" in filters:
+            songs = [song for song in [filters["file"]]
+                     if song in self.last_modified]
+        else:
+            start = bisect.bisect_left(self.mtimes,
+                                       int(filters.get("modified-since", 0)))
+            songs = [song for song, _ in self.songs[start:]]
+        if "window" in filters:
+            start, end = map(int, filters["window"].split(":"))
+            songs = songs[start:end]
+        lines = []
+        for song in songs:
+            lines.append("file: %s" % (song,))
+            lines.append("Last-Modified: %s" % (self.last_modified[song],))
+        return lines
+
+
+def launcher():
+    """
+    Run the workloads received on stdin, as JSON lines with args, env and
+    log keys, and write their exit code, duration and peak RSS on stdout.
+
+    Workloads are run from this small process rather than from the benchmark
+    process, as processes inherit the peak RSS of the process they were
+    forked from.
+    """
+    for line in sys.stdin:
+        request = json.loads(line)
+        with open(request["log"], "a") as log:
+            log.write("$ %s\n" % (" ".join(request["args"]),))
+            log.flush()
+            start = time.monotonic()
+            process = subprocess.Popen(request["args"], env=request["env"],
+                                       stdout=log, stderr=subprocess.STDOUT)
+            # Resource usage of the process tree of the workload only
+            _, status, rusage = os.wait4(process.pid, 0)
+            duration = time.monotonic() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        print(json.dumps({"returncode": process.returncode,
+                          "seconds": duration,
+                          "max_rss_kb": rusage.ru_maxrss}), flush=True)
+
+
+def run(workloads_launcher, name, args, env, log, items):
+    """
+    Run a workload in its own process.
+
+    Params:
+        - workloads_launcher: The launcher process running the workloads.
+        - name: Name of the workload.
+        - args: Command line of the workload.
+        - env: Environment of the workload.
+        - log: File receiving the output of the workload.
+        - items: Number of items (songs or albums) processed by the workload,
+        for its throughput.
+    Returns: A dict of measures, without the MPD round-trips.
+    """
+    logging.info("Running %s." % (name,))
+    workloads_launcher.stdin.write(
+        json.dumps({"args": args, "env": env, "log": log}) + "\n")
+    workloads_launcher.stdin.flush()
+    measures = json.loads(workloads_launcher.stdout.readline())
+    if measures["returncode"] != 0:
+        logging.error("%s failed with exit code %d, see %s." %
+                      (name, measures["returncode"], log))
+    duration = measures["seconds"]
+    return {
+        "workload": name,
+        "returncode": measures["returncode"],
+        "seconds": round(duration, 3),
+        "items": items,
+        "throughput": round(items / duration, 3) if duration else None,
+        "max_rss_kb": measures["max_rss_kb"],
+    }
+
+
+def benchmark_size(workloads_launcher, size, workdir,
+                   queue_length=_QUEUE_LENGTH, top_k=_TOP_K,
+                   max_distances_size=_MAX_DISTANCES_SIZE, jobs=None,
+                   seed=0):
+    """
+    Run all the workloads on a synthetic library.
+
+    Params:
+        - workloads_launcher: The launcher process running the workloads.
+        - size: Number of songs of the library.
+        - workdir: Folder where the library and the db are generated.
+        - queue_length: Number of songs (or albums) added by the clients.
+        - top_k: Number of neighbours stored by build_cache.py.
+        - max_distances_size: Largest library for which the full distances
+        cache is built.
+        - jobs: Number of blissify processes run by server.py.
+        - seed: Random seed of the library.
+    Returns: A list of measures dicts.
+    """
+    mpd_root = os.path.join(workdir, "music")
+    data_home = os.path.join(workdir, "data")
+    bin_dir = os.path.join(workdir, "bin")
+    logging.info("Generating a library of %d songs in %s." % (size, workdir))
+    songs = generate_songs(size, seed=seed)
+    create_files(mpd_root, songs)
+    create_db(os.path.join(data_home, "blissify", "db.sqlite3"), songs)
+    os.makedirs(bin_dir, exist_ok=True)
+    with open(os.path.join(bin_dir, "blissify"), "w") as fh:
+        fh.write("#!/bin/sh\nexec %s %s --stub-blissify \"$@\"\n" %
+                 (shlex.quote(sys.executable),
+                  shlex.quote(os.path.abspath(__file__))))
+    os.chmod(os.path.join(bin_dir, "blissify"), 0o755)
+
+    mpd_server = FakeMPD(songs)
+    threading.Thread(target=mpd_server.serve_forever, daemon=True).start()
+    env = dict(os.environ,
+               XDG_DATA_HOME=data_home,
+               MPD_HOST="127.0.0.1",
+               MPD_PORT=str(mpd_server.server_address[1]),
+               PATH="%s%s%s" % (bin_dir, os.pathsep, os.environ.get("PATH", "")))
+    jobs_args = ["--jobs", str(jobs)] if jobs else []
+    # Start mixes from a song in the middle of the library
+    start_song = songs[len(songs) // 2][0]
+    nb_albums = len({os.path.dirname(song) for song, _ in songs})
+
+    workloads = []
+    if size <= max_distances_size:
+        workloads.append(("build_cache_distances",
+                          [_BUILD_CACHE, "--bulk"], size * (size - 1) // 2))
+    workloads += [
+        ("build_cache_neighbours", [_BUILD_CACHE, "--top-k", str(top_k)],
+         size),
+        ("client_single", [_CLIENT, "--song-based", "--queue-length",
+                           str(queue_length)], queue_length),
+        ("client_plan", [_CLIENT, "--song-based", "--plan",
+                         "--queue-length", str(queue_length)], queue_length),
+        ("client_album", [_CLIENT, "--album-based", "--queue-length",
+                          str(min(queue_length, nb_albums - 1))],
+         min(queue_length, nb_albums - 1)),
+        # Songs of the generated db are not in the manifest yet
+        ("server_manifest_rescan",
+         [_SERVER, mpd_root, "--full-rescan"] + jobs_args, size),
+        ("server_full_rescan",
+         [_SERVER, mpd_root, "--full-rescan", "--purge"] + jobs_args, size),
+        ("server_update", [_SERVER, mpd_root, "--update"] + jobs_args, None),
+    ]
+
+    results = []
+    log = os.path.join(workdir, "benchmark.log")
+    for name, args, items in workloads:
+        if name.startswith("client_"):
+            with mpd_server.lock:
+                mpd_server.playlist = [start_song]
+        if name == "server_update":
+            # Add and remove some songs, added songs being the newest
+            nb_changes = max(1, int(size * _CHANGES))
+            added = generate_songs(nb_changes, first_album=10 * size,
+                                   first_mtime=songs[-1][1] + 3600,
+                                   seed=seed + 1)
+            removed = songs[:nb_changes]
+            create_files(mpd_root, added)
+            for song, _ in removed:
+                os.remove(os.path.join(mpd_root, song))
+            songs = songs[nb_changes:] + added
+            mpd_server.set_library(songs)
+            items = len(added) + len(removed)
+        mpd_server.reset_counts()
+        stats = os.path.join(workdir, "%s.stats.json" % (name,))
+        result = run(workloads_launcher, name,
+                     [sys.executable] + args + ["--stats", stats], env, log,
+                     items)
+        counts = mpd_server.reset_counts()
+        result["size"] = size
+        result["mpd_connections"] = counts.pop("connections", 0)
+        result["mpd_round_trips"] = sum(counts.values())
+        result["mpd_commands"] = dict(counts)
+        try:
+            with open(stats) as fh:
+                phases = json.load(fh)
+            result["timers"] = phases["timers"]
+            result["counters"] = phases["counters"]
+        except FileNotFoundError:
+            pass
+        results.append(result)
+    mpd_server.shutdown()
+    mpd_server.server_close()
+    return results
+
+
+def main(sizes=_SIZES, workdir=None, output=None, queue_length=_QUEUE_LENGTH,
+         top_k=_TOP_K, max_distances_size=_MAX_DISTANCES_SIZE, jobs=None,
+         seed=0):
+    # Started first, while the benchmark process is still small
+    workloads_launcher = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--launcher"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    keep = workdir is not None
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix="blissify-benchmark-")
+    try:
+        numpy_version = importlib.metadata.version("numpy")
+    except importlib.metadata.PackageNotFoundError:
+        numpy_version = None
+    report = {
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": numpy_version,
+        "sqlite": sqlite3.sqlite_version,
+        "results": [],
+    }
+    try:
+        for size in sizes:
+            size_workdir = os.path.join(workdir, str(size))
+            if os.path.exists(size_workdir):
+                shutil.rmtree(size_workdir)
+            report["results"] += benchmark_size(
+                workloads_launcher, size, size_workdir, queue_length, top_k, max_distances_size,
+                jobs, seed)
+    finally:
+        workloads_launcher.stdin.close()
+        workloads_launcher.wait()
+        if not keep:
+            shutil.rmtree(workdir)
+    if output is None:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(output, "w") as fh:
+            json.dump(report, fh, indent=2)
+            fh.write("\n")
+    return report
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--stub-blissify"]:
+        stub_blissify(sys.argv[2], sys.argv[3:])
+        sys.exit()
+    if sys.argv[1:] == ["--launcher"]:
+        launcher()
+        sys.exit()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", help="Numbers of songs of the synthetic libraries.",
+                        type=int, nargs="+", default=_SIZES)
+    parser.add_argument("--workdir",
+                        help="Folder where the libraries are generated, and kept (defaults to a temporary folder).")
+    parser.add_argument("--output", help="JSON report file (defaults to stdout).")
+    parser.add_argument("--queue-length",
+                        help="Number of songs (or albums) added by the clients.",
+                        type=int, default=_QUEUE_LENGTH)
+    parser.add_argument("--top-k", help="Number of neighbours stored by build_cache.py.",
+                        type=int, default=_TOP_K)
+    parser.add_argument("--max-distances-size",
+                        help="Largest library for which the full distances cache is built.",
+                        type=int, default=_MAX_DISTANCES_SIZE)
+    parser.add_argument("--jobs", help="Number of blissify processes run by server.py.",
+                        type=int)
+    parser.add_argument("--seed", help="Random seed of the synthetic libraries.",
+                        type=int, default=0)
+    args = parser.parse_args()
+
+    main(args.sizes, args.workdir, args.output, args.queue_length,
+         args.top_k, args.max_distances_size, args.jobs, args.seed)
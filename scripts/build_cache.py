@@ -1,8 +1,41 @@
 #!/usr/bin/env python3
+"""
+This is a script to precompute the pairwise distances between the songs of the
+blissify db and store them in the distances cache.
+
+Run `python3 build_cache.py --help` for more infos on how to use.
+
+Distances are computed on the normalised features of the songs, see
+`mpd/normalisation.py`.
+
+_Note_: `numpy` is used to compute the distances by tiles if available. The
+scalar engine is kept as a reference implementation.
+"""
+import argparse
+import hashlib
+import heapq
+import itertools
+import json
 import logging
 import math
+import multiprocessing
 import os
 import sqlite3
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Share the db schema handling with the MPD scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "mpd"))
+import instrument
+import normalisation
+import replica
+import schema
+import snapshot
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -11,87 +44,967 @@ if "XDG_DATA_HOME" in os.environ:
 else:
     _BLISSIFY_DATA_HOME = os.path.expanduser("~/.local/share/blissify")
 
+_FEATURES = ["tempo", "amplitude", "frequency", "attack"]
+_TILE_SIZE = 512
+_BATCH_SIZE = 100000
+_BLOCK_SIZE = 64
+_NEIGHBOURS_SCHEMA = schema.table(
+    "CREATE TABLE IF NOT EXISTS neighbours(song INTEGER, neighbour INTEGER, distance REAL, similarity REAL, FOREIGN KEY(song) REFERENCES songs(id) ON DELETE CASCADE, FOREIGN KEY(neighbour) REFERENCES songs(id) ON DELETE CASCADE, PRIMARY KEY (song, neighbour)) WITHOUT ROWID")
+_STAGING_SCHEMA = schema.table(
+    "CREATE TABLE IF NOT EXISTS distances_staging(song1 INTEGER, song2 INTEGER, distance REAL, similarity REAL)")
+# Songs missing from a cache: songs above its high-water mark, and songs
+# without any cached row, as SQLite reuses the ids of the last songs when they
+# are deleted
+_NEW_SONGS_QUERIES = {
+    "distances": schema.query(
+        "SELECT id FROM songs WHERE id>? OR (NOT EXISTS (SELECT 1 FROM distances WHERE song1=songs.id) AND NOT EXISTS (SELECT 1 FROM distances WHERE song2=songs.id))",
+        ["distances"]),
+    "neighbours": schema.query(
+        "SELECT id FROM songs WHERE id>? OR NOT EXISTS (SELECT 1 FROM neighbours WHERE song=songs.id)",
+        ["neighbours"]),
+}
+_CLEAR_QUERIES = {
+    cache: schema.query("DELETE FROM %s" % (cache,))
+    for cache in ["distances", "neighbours"]
+}
+_SONGS_QUERY = schema.query(
+    "SELECT id, tempo, amplitude, frequency, attack, norm, filename FROM song_features",
+    ["features"])
+_PAIRS_QUERY = schema.query("SELECT song1, song2 FROM distances")
+_HAS_DISTANCES_QUERY = schema.query("SELECT song1 FROM distances LIMIT 1")
+_INSERT_DISTANCE_QUERY = schema.query(
+    "INSERT INTO distances(song1, song2, distance, similarity) VALUES(?, ?, ?, ?)")
+_INSERT_STAGING_QUERY = schema.query(
+    "INSERT INTO distances_staging(song1, song2, distance, similarity) VALUES(?, ?, ?, ?)")
+_FLUSH_STAGING_QUERY = schema.query(
+    "INSERT OR IGNORE INTO distances(song1, song2, distance, similarity) SELECT song1, song2, distance, similarity FROM distances_staging ORDER BY song1, song2",
+    ["distances"])
+_INSERT_NEIGHBOUR_QUERY = schema.query(
+    "INSERT INTO neighbours(song, neighbour, distance, similarity) VALUES(?, ?, ?, ?)")
+_SONG_NEIGHBOURS_QUERY = schema.query(
+    "SELECT song, neighbour, distance, similarity FROM neighbours WHERE song=?",
+    ["neighbours"])
+_DELETE_NEIGHBOURS_QUERY = schema.query(
+    "DELETE FROM neighbours WHERE song=?", ["neighbours"])
+_SHORT_NEIGHBOURS_QUERY = schema.query(
+    "SELECT song FROM neighbours GROUP BY song HAVING COUNT(*)<?")
+_NEIGHBOURS_LIMITS_QUERY = schema.query(
+    "SELECT song, MAX(distance) FROM neighbours GROUP BY song")
+_METADATA_QUERY = schema.query("SELECT value FROM metadata WHERE name=?",
+                               ["metadata"])
+_SET_METADATA_QUERY = schema.query(
+    "INSERT OR REPLACE INTO metadata(name, value) VALUES(?, ?)")
+_CHECKPOINT_QUERY = schema.query(
+    "SELECT value FROM metadata WHERE name='cache_checkpoint'", ["metadata"])
+_SET_CHECKPOINT_QUERY = schema.query(
+    "INSERT OR REPLACE INTO metadata(name, value) VALUES('cache_checkpoint', ?)")
+_CLEAR_CHECKPOINT_QUERY = schema.query(
+    "DELETE FROM metadata WHERE name='cache_checkpoint'", ["metadata"])
+_NEIGHBOURS_K_QUERY = schema.query(
+    "SELECT value FROM metadata WHERE name='neighbours_k'", ["metadata"])
+_SET_NEIGHBOURS_K_QUERY = schema.query(
+    "INSERT OR REPLACE INTO metadata(name, value) VALUES('neighbours_k', ?)")
+# Maximal deviation allowed between numpy engine and scalar reference
+_TOLERANCE = 1e-9
+
+
+def distance(song1, song2):
+    """
+    Compute the cartesian distance between two songs (scalar reference).
+    """
+    return math.sqrt(
+        (song1["tempo"] - song2["tempo"])**2 +
+        (song1["amplitude"] - song2["amplitude"])**2 +
+        (song1["frequency"] - song2["frequency"])**2 +
+        (song1["attack"] - song2["attack"])**2
+    )
+
+
+def similarity(song1, song2):
+    """
+    Compute the cosine similarity between two songs (scalar reference), using
+    their precomputed norms. It is 0 if one of the songs has a zero norm, see
+    `mpd/normalisation.py`.
+    """
+    if not song1["norm"] or not song2["norm"]:
+        return 0.0
+    return (
+        (song1["tempo"] * song2["tempo"] +
+         song1["amplitude"] * song2["amplitude"] +
+         song1["frequency"] * song2["frequency"] +
+         song1["attack"] * song2["attack"]) /
+        (song1["norm"] * song2["norm"])
+    )
+
+
+def load_features(all_songs):
+    """
+    Pack the features of the songs in a contiguous (n, 4) float array.
+    """
+    return numpy.ascontiguousarray(
+        [[song[feature] for feature in _FEATURES] for song in all_songs],
+        dtype=numpy.float64)
+
+
+def load_units(all_songs, features):
+    """
+    Scale the features of the songs by their precomputed norms, so that
+    cosine similarities are dot products.
+
+    Returns: A (n, 4) array of unit vectors, and of zero vectors for the
+    songs with a zero norm, so that their similarities are 0.
+    """
+    norms = numpy.array([song["norm"] for song in all_songs],
+                        dtype=numpy.float64)[:, None]
+    return numpy.divide(features, norms, out=numpy.zeros_like(features),
+                        where=norms != 0)
+
+
+def iter_tiles(features, units, tile_size=_TILE_SIZE, row_start=0,
+               row_end=None):
+    """
+    Compute distances and similarities on the upper triangular part of the
+    pairs matrix, tile by tile.
+
+    Params:
+        - features: A (n, 4) array of song features.
+        - units: The features scaled to unit vectors.
+        - tile_size: Number of rows (and columns) of a tile.
+        - row_start: First row of the pairs matrix to compute.
+        - row_end: Row of the pairs matrix to stop at (default is last row).
+    Returns: An iterator over (tile_row, tile_col, distances, similarities)
+    tuples.
+    """
+    if row_end is None:
+        row_end = len(features)
+    for tile_row in range(row_start, row_end, tile_size):
+        tile_row_end = min(tile_row + tile_size, row_end)
+        rows = features[tile_row:tile_row_end]
+        row_units = units[tile_row:tile_row_end]
+        for tile_col in range(tile_row, len(features), tile_size):
+            cols = features[tile_col:tile_col + tile_size]
+            col_units = units[tile_col:tile_col + tile_size]
+            distances, similarities = tile_metrics(rows, row_units,
+                                                   cols, col_units)
+            yield tile_row, tile_col, distances, similarities
+
+
+def tile_metrics(rows, row_units, cols, col_units):
+    """
+    Compute distances and similarities between two sets of songs.
+
+    Params:
+        - rows, cols: (n, 4) and (m, 4) arrays of song features.
+        - row_units, col_units: The features scaled to unit vectors.
+    Returns: A (distances, similarities) tuple of (n, m) arrays.
+    """
+    diff = rows[:, None, :] - cols[None, :, :]
+    distances = numpy.sqrt(numpy.einsum("ijk,ijk->ij", diff, diff))
+    return distances, row_units @ col_units.T
+
+
+def upper_pairs(ids, tile_row, tile_col, distances, similarities):
+    """
+    Select the pairs strictly above the diagonal of the pairs matrix in a
+    tile.
+
+    Returns: A (song1, song2, distance, similarity) tuple of lists.
+    """
+    row_indices = numpy.arange(tile_row, tile_row + distances.shape[0])
+    col_indices = numpy.arange(tile_col, tile_col + distances.shape[1])
+    rows, cols = numpy.nonzero(row_indices[:, None] < col_indices[None, :])
+    return (ids[tile_row + rows].tolist(),
+            ids[tile_col + cols].tolist(),
+            distances[rows, cols].tolist(),
+            similarities[rows, cols].tolist())
+
+
+def verify_tile(all_songs, row_start, col_start, distances, similarities):
+    """
+    Check a tile computed by the numpy engine against the scalar reference.
+    """
+    for i in range(distances.shape[0]):
+        for j in range(distances.shape[1]):
+            song1 = all_songs[row_start + i]
+            song2 = all_songs[col_start + j]
+            if song1["id"] == song2["id"]:
+                continue
+            if not (math.isclose(distances[i, j], distance(song1, song2),
+                                 rel_tol=_TOLERANCE, abs_tol=_TOLERANCE) and
+                    math.isclose(similarities[i, j], similarity(song1, song2),
+                                 rel_tol=_TOLERANCE, abs_tol=_TOLERANCE)):
+                raise AssertionError(
+                    "Numpy engine differs from scalar reference for %s and %s."
+                    % (song1["filename"], song2["filename"]))
+
+
+def iter_batches_scalar(all_songs, row_start=0, row_end=None):
+    """
+    Compute pairwise distances with the scalar reference engine.
+
+    Returns: An iterator over lists of (song1, song2, distance, similarity)
+    tuples, one list per song.
+    """
+    if row_end is None:
+        row_end = len(all_songs)
+    for i in range(row_start, row_end):
+        song1 = all_songs[i]
+        instrument.count("pairs_computed", len(all_songs) - i - 1)
+        yield [
+            (song1["id"], song2["id"],
+             distance(song1, song2), similarity(song1, song2))
+            for song2 in all_songs[i + 1:]
+        ]
+
+
+def iter_batches_numpy(all_songs, tile_size=_TILE_SIZE, verify=False,
+                       row_start=0, row_end=None):
+    """
+    Compute pairwise distances with the numpy engine.
+
+    Returns: An iterator over lists of (song1, song2, distance, similarity)
+    tuples, one list per tile.
+    """
+    ids = numpy.array([song["id"] for song in all_songs], dtype=numpy.int64)
+    features = load_features(all_songs)
+    units = load_units(all_songs, features)
+    for tile_row, tile_col, distances, similarities in iter_tiles(
+            features, units, tile_size, row_start, row_end):
+        if verify:
+            verify_tile(all_songs, tile_row, tile_col,
+                        distances, similarities)
+        batch = list(zip(*upper_pairs(ids, tile_row, tile_col,
+                                      distances, similarities)))
+        instrument.count("pairs_computed", len(batch))
+        yield batch
+
+
+def canonical_pair(song1, song2):
+    """
+    Returns: The (song1, song2) pair ordered by ids, as stored in the cache
+    index.
+    """
+    return (song1, song2) if song1 < song2 else (song2, song1)
+
+
+def load_cached_pairs(cur):
+    """
+    Load the set of pairs already stored in the distances cache.
+
+    Returns: A set of canonical (song1, song2) pairs.
+    """
+    cur.execute(_PAIRS_QUERY)
+    return {canonical_pair(song1, song2) for song1, song2 in cur}
+
+
+def set_pragmas(conn, journal_mode=None, synchronous=None):
+    """
+    Set the journal mode and synchronous pragmas of the db connection, if
+    specified.
+    """
+    if journal_mode is not None:
+        conn.execute("PRAGMA journal_mode=%s" % (journal_mode,))
+    if synchronous is not None:
+        conn.execute("PRAGMA synchronous=%s" % (synchronous,))
+
+
+def flush_staging(conn, clear_checkpoint=False):
+    """
+    Move the distances loaded in the staging table to the distances table and
+    drop the staging table.
+
+    Params:
+        - conn: The db connection.
+        - clear_checkpoint: Whether to delete the checkpoint of the parallel
+        run in the same transaction, once all its blocks are stored.
+    """
+    with instrument.timer("index_build"), conn:
+        conn.execute(_STAGING_SCHEMA)
+        # Insert sorted rows, so that the UNIQUE index is built sequentially
+        cur = conn.execute(_FLUSH_STAGING_QUERY)
+        instrument.count("db_rows_written", cur.rowcount)
+        conn.execute("DROP TABLE distances_staging")
+        if clear_checkpoint:
+            # Blocks of a complete run must not be skipped by the next runs,
+            # the distances being possibly emptied in between
+            conn.execute(_CLEAR_CHECKPOINT_QUERY)
+
+
+def store_single(conn, pairs):
+    """
+    Store distances in db cache, one transaction per pair.
+
+    Params:
+        - conn: The db connection.
+        - pairs: An iterable of (song1, song2, distance, similarity) tuples.
+    """
+    for song1, song2, distance, similarity in pairs:
+        # Store distance in db cache
+        try:
+            with instrument.timer("db_write"):
+                conn.execute(_INSERT_DISTANCE_QUERY,
+                             (song1, song2, distance, similarity))
+                conn.commit()
+            instrument.count("db_rows_written")
+        except sqlite3.IntegrityError:
+            logging.warning("Unable to insert distance between %d and %d in database." %
+                            (song1, song2))
+            conn.rollback()
+
+
+def store_bulk(conn, pairs, batch_size=_BATCH_SIZE):
+    """
+    Store distances in db cache, loading them in a staging table with one
+    transaction per batch and building the index at the end.
+
+    Params:
+        - conn: The db connection.
+        - pairs: An iterable of (song1, song2, distance, similarity) tuples.
+        - batch_size: Number of pairs to write per transaction.
+    """
+    conn.execute(_STAGING_SCHEMA)
+    conn.commit()
+    pairs = iter(pairs)
+    nb_pairs = 0
+    while True:
+        batch = list(itertools.islice(pairs, batch_size))
+        if not batch:
+            break
+        with instrument.timer("db_write"), conn:
+            conn.executemany(_INSERT_STAGING_QUERY, batch)
+        instrument.count("staging_rows_written", len(batch))
+        nb_pairs += len(batch)
+        logging.debug("Stored %d distances in staging table." % (nb_pairs,))
+    logging.info("Building distances index for %d new pairs." % (nb_pairs,))
+    flush_staging(conn)
+
+
+def _init_worker(all_songs, engine, tile_size, verify):
+    """
+    Initialize the state shared by all the blocks computed in a worker
+    process.
+    """
+    global _WORKER
+    _WORKER = {
+        "all_songs": all_songs,
+        "engine": engine,
+        "tile_size": tile_size,
+        "verify": verify
+    }
+    if engine == "numpy":
+        _WORKER["ids"] = numpy.array([song["id"] for song in all_songs],
+                                     dtype=numpy.int64)
+        _WORKER["features"] = load_features(all_songs)
+        _WORKER["units"] = load_units(all_songs, _WORKER["features"])
+
+
+def _compute_block(block):
+    """
+    Compute all the pairs in a row block, in a worker process.
+
+    Params:
+        - block: A (row_start, row_end) tuple.
+    Returns: A (block, pairs) tuple, pairs being a list of
+    (song1, song2, distance, similarity) tuples.
+    """
+    row_start, row_end = block
+    all_songs = _WORKER["all_songs"]
+    if _WORKER["engine"] == "scalar":
+        pairs = [pair
+                 for batch in iter_batches_scalar(all_songs, row_start, row_end)
+                 for pair in batch]
+        return block, pairs
+    pairs = []
+    for tile_row, tile_col, distances, similarities in iter_tiles(
+            _WORKER["features"], _WORKER["units"], _WORKER["tile_size"],
+            row_start, row_end):
+        if _WORKER["verify"]:
+            verify_tile(all_songs, tile_row, tile_col,
+                        distances, similarities)
+        pairs.extend(zip(*upper_pairs(_WORKER["ids"], tile_row, tile_col,
+                                      distances, similarities)))
+    return block, pairs
+
 
-def main():
+def load_checkpoint(conn, signature):
+    """
+    Load the row blocks already stored by a previous parallel run.
+
+    Params:
+        - conn: The db connection.
+        - signature: The signature of the current run. Checkpoints from runs
+        with another signature are discarded.
+    Returns: A set of row_start of the completed blocks.
+    """
+    row = conn.execute(_CHECKPOINT_QUERY).fetchone()
+    if row is None:
+        return set()
+    checkpoint = json.loads(row["value"])
+    if checkpoint["signature"] != signature:
+        logging.info("Discarding checkpoint from a previous run on other songs.")
+        return set()
+    return set(checkpoint["done"])
+
+
+def save_checkpoint(conn, signature, done):
+    """
+    Store the row blocks completed by the current parallel run. Should be
+    called in the transaction storing the distances of the blocks.
+    """
+    conn.execute(
+        _SET_CHECKPOINT_QUERY,
+        (json.dumps({"signature": signature, "done": sorted(done)}),))
+
+
+def build_parallel(conn, all_songs, engine, tile_size=_TILE_SIZE,
+                   verify=False, workers=1, block_size=_BLOCK_SIZE):
+    """
+    Compute pairwise distances in worker processes, by row blocks of the
+    upper triangular pairs matrix. Distances are written by the calling
+    process only, each block in a single transaction along with a checkpoint
+    in the metadata table, so that an interrupted run can be resumed.
+
+    Params:
+        - conn: The db connection.
+        - all_songs: The list of all the songs.
+        - engine: Engine used to compute distances.
+        - tile_size: Number of songs per tile for the numpy engine.
+        - verify: Whether to check numpy results against the scalar engine.
+        - workers: Number of worker processes.
+        - block_size: Number of rows of the pairs matrix per block.
+    """
+    signature = "%d:%s" % (
+        block_size,
+        hashlib.sha1(",".join(str(song["id"])
+                              for song in all_songs).encode()).hexdigest())
+    done = load_checkpoint(conn, signature)
+    blocks = [(row_start, min(row_start + block_size, len(all_songs)))
+              for row_start in range(0, len(all_songs), block_size)
+              if row_start not in done]
+    logging.info("%d blocks to compute, %d already done." %
+                 (len(blocks), len(done)))
+
+    conn.execute(_STAGING_SCHEMA)
+    conn.commit()
+    songs = [dict(song) for song in all_songs]
+    with multiprocessing.Pool(workers, _init_worker,
+                              (songs, engine, tile_size, verify)) as pool:
+        # Only the time spent waiting for the workers is timed
+        for block, pairs in instrument.timed(
+                "distances", pool.imap_unordered(_compute_block, blocks)):
+            instrument.count("pairs_computed", len(pairs))
+            with instrument.timer("db_write"), conn:
+                conn.executemany(_INSERT_STAGING_QUERY, pairs)
+                done.add(block[0])
+                save_checkpoint(conn, signature, done)
+            instrument.count("staging_rows_written", len(pairs))
+            logging.debug("Stored block %d-%d (%d distances)." %
+                          (block[0], block[1], len(pairs)))
+    logging.info("Building distances index.")
+    flush_staging(conn, clear_checkpoint=True)
+
+
+def iter_neighbours_scalar(all_songs, k, indices=None):
+    """
+    Compute the k nearest neighbours of every song (or of the songs at some
+    indices in all_songs) with the scalar reference engine.
+
+    Returns: An iterator over lists of (song, neighbour, distance, similarity)
+    tuples, one list per song.
+    """
+    if indices is None:
+        indices = range(len(all_songs))
+    for index in indices:
+        song = all_songs[index]
+        instrument.count("pairs_computed", len(all_songs) - 1)
+        neighbours = heapq.nsmallest(
+            k,
+            (other for other in all_songs if other["id"] != song["id"]),
+            key=lambda other: distance(song, other))
+        yield [(song["id"], other["id"],
+                distance(song, other), similarity(song, other))
+               for other in neighbours]
+
+
+def iter_neighbours_numpy(all_songs, k, tile_size=_TILE_SIZE, indices=None):
+    """
+    Compute the k nearest neighbours of every song (or of the songs at some
+    indices in all_songs) with the numpy engine, keeping the k best
+    candidates of each row while iterating over column tiles.
+
+    Returns: An iterator over lists of (song, neighbour, distance, similarity)
+    tuples, one list per row tile.
+    """
+    ids = numpy.array([song["id"] for song in all_songs], dtype=numpy.int64)
+    features = load_features(all_songs)
+    units = load_units(all_songs, features)
+    if indices is None:
+        indices = numpy.arange(len(features))
+    else:
+        indices = numpy.asarray(indices, dtype=numpy.int64)
+    k = min(k, len(features) - 1)
+    if k <= 0:
+        return
+    for tile_row in range(0, len(indices), tile_size):
+        row_indices = indices[tile_row:tile_row + tile_size]
+        rows = features[row_indices]
+        instrument.count("pairs_computed", len(rows) * (len(features) - 1))
+        best_distances = numpy.empty((len(rows), 0))
+        best_indices = numpy.empty((len(rows), 0), dtype=numpy.int64)
+        for tile_col in range(0, len(features), tile_size):
+            cols = features[tile_col:tile_col + tile_size]
+            col_indices = numpy.arange(tile_col, tile_col + len(cols))
+            diff = rows[:, None, :] - cols[None, :, :]
+            distances = numpy.sqrt(numpy.einsum("ijk,ijk->ij", diff, diff))
+            # A song is not its own neighbour
+            distances[row_indices[:, None] == col_indices[None, :]] = numpy.inf
+            best_distances = numpy.hstack([best_distances, distances])
+            best_indices = numpy.hstack([
+                best_indices,
+                numpy.broadcast_to(col_indices, distances.shape)])
+            if best_distances.shape[1] > k:
+                kept = numpy.argpartition(best_distances, k - 1, axis=1)[:, :k]
+                best_distances = numpy.take_along_axis(best_distances, kept, 1)
+                best_indices = numpy.take_along_axis(best_indices, kept, 1)
+        order = numpy.argsort(best_distances, axis=1, kind="stable")
+        best_distances = numpy.take_along_axis(best_distances, order, 1)
+        best_indices = numpy.take_along_axis(best_indices, order, 1)
+        similarities = numpy.einsum("ij,ikj->ik", units[row_indices],
+                                    units[best_indices])
+        yield list(zip(numpy.repeat(ids[row_indices], k).tolist(),
+                       ids[best_indices].ravel().tolist(),
+                       best_distances.ravel().tolist(),
+                       similarities.ravel().tolist()))
+
+
+def store_neighbours(conn, batches, k):
+    """
+    Replace the content of the neighbours table, in a single transaction.
+
+    Params:
+        - conn: The db connection.
+        - batches: An iterable of lists of (song, neighbour, distance,
+        similarity) tuples.
+        - k: Number of neighbours stored per song.
+    """
+    nb_rows = 0
+    with conn:
+        conn.execute(_NEIGHBOURS_SCHEMA)
+        schema.init_neighbours_index(conn)
+        conn.execute(_CLEAR_QUERIES["neighbours"])
+        for batch in batches:
+            with instrument.timer("db_write"):
+                conn.executemany(_INSERT_NEIGHBOUR_QUERY, batch)
+            nb_rows += len(batch)
+        instrument.count("db_rows_written", nb_rows)
+        conn.execute(_SET_NEIGHBOURS_K_QUERY, (str(k),))
+    logging.info("Stored %d neighbours (k=%d)." % (nb_rows, k))
+
+
+def load_max_id(conn, cache):
+    """
+    Returns: The high-water mark of a cache, i.e. the highest song id when it
+    was last built or updated, or None.
+    """
+    row = conn.execute(_METADATA_QUERY,
+                       ("%s_max_id" % (cache,),)).fetchone()
+    return int(row["value"]) if row is not None else None
+
+
+def save_max_id(conn, cache, all_songs, features_version):
+    """
+    Store the high-water mark of a cache and the version of the features it
+    was computed from, once it covers all the songs.
+    """
+    if not all_songs:
+        return
+    with conn:
+        conn.execute(
+            _SET_METADATA_QUERY,
+            ("%s_max_id" % (cache,), str(max(song["id"] for song in all_songs))))
+        conn.execute(
+            _SET_METADATA_QUERY,
+            ("%s_features_version" % (cache,), str(features_version)))
+
+
+def clear_stale_caches(conn, features_version):
+    """
+    Empty the caches computed from features of another version. Their
+    high-water mark is reset, so that they are computed again by incremental
+    updates.
+    """
+    caches = []
+    if (load_max_id(conn, "distances") is not None or
+            conn.execute(_HAS_DISTANCES_QUERY).fetchone()):
+        caches.append("distances")
+    if (schema.has_table(conn, "neighbours") and
+            conn.execute(_NEIGHBOURS_K_QUERY).fetchone()):
+        caches.append("neighbours")
+    for cache in caches:
+        row = conn.execute(_METADATA_QUERY,
+                           ("%s_features_version" % (cache,),)).fetchone()
+        if row is not None and int(row["value"]) == features_version:
+            continue
+        logging.info("Features were normalised again, clearing %s cache." %
+                     (cache,))
+        with conn:
+            conn.execute(_CLEAR_QUERIES[cache])
+            conn.execute(_CLEAR_CHECKPOINT_QUERY)
+            conn.execute(_SET_METADATA_QUERY, ("%s_max_id" % (cache,), "0"))
+            conn.execute(
+                _SET_METADATA_QUERY,
+                ("%s_features_version" % (cache,), str(features_version)))
+
+
+def find_new_songs(conn, all_songs, cache):
+    """
+    Find the songs missing from a cache.
+
+    Params:
+        - conn: The db connection.
+        - all_songs: The list of all the songs.
+        - cache: Either "distances" or "neighbours".
+    Returns: The sorted indices in all_songs of the new songs.
+    """
+    max_id = load_max_id(conn, cache)
+    if max_id is None:
+        # Cache built before high-water marks were stored
+        max_id = max((song["id"] for song in all_songs), default=0)
+    new_ids = {row[0] for row in conn.execute(_NEW_SONGS_QUERIES[cache],
+                                              (max_id,))}
+    return [index for index, song in enumerate(all_songs)
+            if song["id"] in new_ids]
+
+
+def iter_new_pairs_scalar(all_songs, new_indices):
+    """
+    Compute the distances between new songs and all the songs with the
+    scalar reference engine.
+
+    Returns: An iterator over lists of (song1, song2, distance, similarity)
+    tuples, one list per new song.
+    """
+    new_set = set(new_indices)
+    for i in new_indices:
+        song1 = all_songs[i]
+        # Pairs of new songs are computed once, from the first one
+        batch = [
+            canonical_pair(song1["id"], song2["id"]) +
+            (distance(song1, song2), similarity(song1, song2))
+            for j, song2 in enumerate(all_songs)
+            if j != i and not (j in new_set and j < i)
+        ]
+        instrument.count("pairs_computed", len(batch))
+        yield batch
+
+
+def iter_new_pairs_numpy(all_songs, new_indices, tile_size=_TILE_SIZE):
+    """
+    Compute the distances between new songs and all the songs with the numpy
+    engine.
+
+    Returns: An iterator over lists of (song1, song2, distance, similarity)
+    tuples, one list per tile.
+    """
+    ids = numpy.array([song["id"] for song in all_songs], dtype=numpy.int64)
+    features = load_features(all_songs)
+    units = load_units(all_songs, features)
+    new_indices = numpy.asarray(new_indices, dtype=numpy.int64)
+    is_new = numpy.zeros(len(features), dtype=bool)
+    is_new[new_indices] = True
+    for tile_row in range(0, len(new_indices), tile_size):
+        row_indices = new_indices[tile_row:tile_row + tile_size]
+        for tile_col in range(0, len(features), tile_size):
+            col_indices = numpy.arange(tile_col,
+                                       min(tile_col + tile_size, len(features)))
+            distances, similarities = tile_metrics(
+                features[row_indices], units[row_indices],
+                features[col_indices], units[col_indices])
+            # Pairs of new songs are computed once, from the first one
+            rows, cols = numpy.nonzero(~(
+                is_new[col_indices][None, :] &
+                (col_indices[None, :] <= row_indices[:, None])))
+            song1 = ids[row_indices[rows]]
+            song2 = ids[col_indices[cols]]
+            instrument.count("pairs_computed", len(rows))
+            yield list(zip(numpy.minimum(song1, song2).tolist(),
+                           numpy.maximum(song1, song2).tolist(),
+                           distances[rows, cols].tolist(),
+                           similarities[rows, cols].tolist()))
+
+
+def iter_closer_scalar(all_songs, new_indices, limits):
+    """
+    Find the new songs closer to existing songs than their farthest cached
+    neighbour, with the scalar reference engine.
+
+    Params:
+        - all_songs: The list of all the songs.
+        - new_indices: Indices in all_songs of the new songs.
+        - limits: A dict mapping the ids of the songs to update to the
+        distance of their farthest cached neighbour.
+    Returns: An iterator over (song, neighbour, distance, similarity) tuples.
+    """
+    new_songs = [all_songs[i] for i in new_indices]
+    for song in all_songs:
+        limit = limits.get(song["id"])
+        if limit is None:
+            continue
+        instrument.count("pairs_computed", len(new_songs))
+        for other in new_songs:
+            other_distance = distance(song, other)
+            if other["id"] != song["id"] and other_distance < limit:
+                yield (song["id"], other["id"], other_distance,
+                       similarity(song, other))
+
+
+def iter_closer_numpy(all_songs, new_indices, limits, tile_size=_TILE_SIZE):
+    """
+    Find the new songs closer to existing songs than their farthest cached
+    neighbour, with the numpy engine.
+
+    Params: See `iter_closer_scalar`.
+    Returns: An iterator over (song, neighbour, distance, similarity) tuples.
+    """
+    ids = numpy.array([song["id"] for song in all_songs], dtype=numpy.int64)
+    features = load_features(all_songs)
+    units = load_units(all_songs, features)
+    new_indices = numpy.asarray(new_indices, dtype=numpy.int64)
+    # Songs not to update can not get closer neighbours
+    limits = numpy.array([limits.get(song["id"], -numpy.inf)
+                          for song in all_songs])
+    for tile_row in range(0, len(features), tile_size):
+        tile_row_end = min(tile_row + tile_size, len(features))
+        instrument.count("pairs_computed",
+                         (tile_row_end - tile_row) * len(new_indices))
+        distances, similarities = tile_metrics(
+            features[tile_row:tile_row_end], units[tile_row:tile_row_end],
+            features[new_indices], units[new_indices])
+        rows, cols = numpy.nonzero(
+            distances < limits[tile_row:tile_row_end, None])
+        yield from zip(ids[tile_row + rows].tolist(),
+                       ids[new_indices[cols]].tolist(),
+                       distances[rows, cols].tolist(),
+                       similarities[rows, cols].tolist())
+
+
+def update_distances(conn, all_songs, features_version, engine,
+                     tile_size=_TILE_SIZE, batch_size=_BATCH_SIZE):
+    """
+    Compute only the distances involving songs missing from the distances
+    cache.
+    """
+    new_indices = find_new_songs(conn, all_songs, "distances")
+    logging.info("Computing distances of %d new songs." % (len(new_indices),))
+    if new_indices:
+        if engine == "numpy":
+            batches = iter_new_pairs_numpy(all_songs, new_indices, tile_size)
+        else:
+            batches = iter_new_pairs_scalar(all_songs, new_indices)
+        batches = instrument.timed("distances", batches)
+        store_bulk(conn, (row for batch in batches for row in batch),
+                   batch_size)
+    save_max_id(conn, "distances", all_songs, features_version)
+
+
+def update_neighbours(conn, all_songs, features_version, k, engine,
+                      tile_size=_TILE_SIZE):
+    """
+    Update the neighbours table for songs added or removed since it was
+    built: new songs and songs which lost neighbours get their neighbours
+    computed, and new songs are merged in the neighbours of the other songs
+    when closer than their farthest cached neighbour.
+    """
+    new_indices = find_new_songs(conn, all_songs, "neighbours")
+    # Songs which lost neighbours with removed songs
+    short_ids = {row[0] for row in conn.execute(
+        _SHORT_NEIGHBOURS_QUERY,
+        (min(k, len(all_songs) - 1),))}
+    recomputed = sorted(set(new_indices).union(
+        index for index, song in enumerate(all_songs)
+        if song["id"] in short_ids))
+    recomputed_ids = {all_songs[index]["id"] for index in recomputed}
+    logging.info("Computing neighbours of %d songs, %d of them new." %
+                 (len(recomputed), len(new_indices)))
+
+    if engine == "numpy":
+        batches = iter_neighbours_numpy(all_songs, k, tile_size, recomputed)
+    else:
+        batches = iter_neighbours_scalar(all_songs, k, recomputed)
+    batches = instrument.timed("distances", batches)
+    limits = {
+        row[0]: row[1] for row in conn.execute(_NEIGHBOURS_LIMITS_QUERY)
+        if row[0] not in recomputed_ids
+    }
+    closer = {}
+    if new_indices and limits:
+        if engine == "numpy":
+            candidates = iter_closer_numpy(all_songs, new_indices, limits,
+                                           tile_size)
+        else:
+            candidates = iter_closer_scalar(all_songs, new_indices, limits)
+        for row in instrument.timed("distances", candidates):
+            closer.setdefault(row[0], []).append(row)
+
+    with conn:
+        for batch in batches:
+            with instrument.timer("db_write"):
+                for song in {row[0] for row in batch}:
+                    conn.execute(_DELETE_NEIGHBOURS_QUERY, (song,))
+                conn.executemany(_INSERT_NEIGHBOUR_QUERY, batch)
+            instrument.count("db_rows_written", len(batch))
+        for song, rows in closer.items():
+            with instrument.timer("db_write"):
+                rows.extend(conn.execute(_SONG_NEIGHBOURS_QUERY,
+                                         (song,)).fetchall())
+                conn.execute(_DELETE_NEIGHBOURS_QUERY, (song,))
+                rows = [tuple(row)
+                        for row in sorted(rows, key=lambda row: row[2])[:k]]
+                conn.executemany(_INSERT_NEIGHBOUR_QUERY, rows)
+            instrument.count("db_rows_written", len(rows))
+    logging.info("Updated neighbours of %d existing songs." % (len(closer),))
+    save_max_id(conn, "neighbours", all_songs, features_version)
+
+
+def update_caches(conn, all_songs, features_version, engine,
+                  tile_size=_TILE_SIZE, batch_size=_BATCH_SIZE):
+    """
+    Update the existing caches with the songs added or removed since they
+    were built.
+    """
+    if (load_max_id(conn, "distances") is not None or
+            conn.execute(_HAS_DISTANCES_QUERY).fetchone()):
+        update_distances(conn, all_songs, features_version, engine,
+                         tile_size, batch_size)
+    row = conn.execute(_NEIGHBOURS_K_QUERY).fetchone()
+    if row is not None and schema.has_table(conn, "neighbours"):
+        update_neighbours(conn, all_songs, features_version,
+                          int(row["value"]), engine, tile_size)
+
+
+def main(engine="numpy", tile_size=_TILE_SIZE, verify=False, bulk=False,
+         batch_size=_BATCH_SIZE, journal_mode=None, synchronous=None,
+         workers=0, block_size=_BLOCK_SIZE, top_k=None, incremental=False,
+         use_replica=False):
     db_path = os.path.join(_BLISSIFY_DATA_HOME, "db.sqlite3")
     logging.debug("Using DB path: %s." % (db_path,))
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    conn.execute('pragma foreign_keys=ON')
+    with instrument.timer("db_init"):
+        conn = sqlite3.connect(db_path)
+        conn.row_factory = sqlite3.Row
+        conn.execute('pragma foreign_keys=ON')
+        set_pragmas(conn, journal_mode, synchronous)
+        schema.migrate(conn)
+        features_version = normalisation.refresh(conn)
     cur = conn.cursor()
 
-    # Get cached distances from db
-    cur.execute("SELECT song1, song2, distance, similarity FROM distances")
-    cached_distances = cur.fetchall()
+    # Recover distances staged by an interrupted run
+    flush_staging(conn)
+    clear_stale_caches(conn, features_version)
+    # Export the songs for the next startups of client.py. Distances are
+    # computed from the double precision features of the db.
+    snapshot.refresh(conn, snapshot.default_path(conn))
 
     # Get all songs
-    cur.execute("SELECT id, tempo, amplitude, frequency, attack, filename FROM songs")
-    all_songs = cur.fetchall()
-
-    for i in range(len(all_songs)):
-        for j in range(i + 1, len(all_songs)):
-            song1 = all_songs[i]
-            song2 = all_songs[j]
-            is_cached = len([i for i in cached_distances
-                             if(i["song1"] == song1["id"] and
-                                i["song2"] == song2["id"]) or
-                             (i["song1"] == song2["id"] and
-                              i["song2"] == song1["id"])]) > 0
-            if is_cached:
-                # Pass pair if cached value is already there
-                continue
-            # Compute distance
-            distance = math.sqrt(
-                (song1["tempo"] - song2["tempo"])**2 +
-                (song1["amplitude"] - song2["amplitude"])**2 +
-                (song1["frequency"] - song2["frequency"])**2 +
-                (song1["attack"] - song2["attack"])**2
-            )
-            similarity = (
-                (song1["tempo"] * song2["tempo"] +
-                 song1["amplitude"] * song2["amplitude"] +
-                 song1["frequency"] * song2["frequency"] +
-                 song1["attack"] * song2["attack"]) /
-                (
-                    math.sqrt(
-                        song1["tempo"]**2 +
-                        song1["amplitude"]**2 +
-                        song1["frequency"]**2 +
-                        song1["attack"]**2) *
-                    math.sqrt(
-                        song2["tempo"]**2 +
-                        song2["amplitude"]**2 +
-                        song2["frequency"]**2 +
-                        song2["attack"]**2)
-                )
-            )
-
-            logging.debug("Distance between %s and %s is (%f, %f)." %
-                          (song1["filename"], song2["filename"], distance,
-                           similarity))
-            # Store distance in db cache
-            try:
-                logging.debug("Storing distance in database.")
-                conn.execute(
-                    "INSERT INTO distances(song1, song2, distance, similarity) VALUES(?, ?, ?, ?)",
-                    (song1["id"], song2["id"], distance, similarity))
-                conn.commit()
-                # Update cached_distances list
-                cached_distances.append({
-                    "song1": song1["id"],
-                    "song2": song2["id"],
-                    "distance": distance,
-                    "similarity": similarity
-                })
-            except sqlite3.IntegrityError:
-                logging.warning("Unable to insert distance in database.")
-                conn.rollback()
+    with instrument.timer("db_read"):
+        cur.execute(_SONGS_QUERY)
+        all_songs = cur.fetchall()
+    instrument.count("songs_scanned", len(all_songs))
+
+    if engine == "numpy" and numpy is None:
+        logging.warning("numpy is not available, using scalar engine.")
+        engine = "scalar"
+    if incremental:
+        update_caches(conn, all_songs, features_version, engine, tile_size,
+                      batch_size)
+    elif top_k is not None:
+        if engine == "numpy":
+            batches = iter_neighbours_numpy(all_songs, top_k, tile_size)
+        else:
+            batches = iter_neighbours_scalar(all_songs, top_k)
+        store_neighbours(conn, instrument.timed("distances", batches), top_k)
+        save_max_id(conn, "neighbours", all_songs, features_version)
+    elif workers > 0:
+        build_parallel(conn, all_songs, engine, tile_size, verify, workers,
+                       block_size)
+        save_max_id(conn, "distances", all_songs, features_version)
+    else:
+        # Get cached pairs from db
+        with instrument.timer("db_read"):
+            cached_pairs = load_cached_pairs(cur)
+        if engine == "numpy":
+            batches = iter_batches_numpy(all_songs, tile_size, verify)
+        else:
+            batches = iter_batches_scalar(all_songs)
+        batches = instrument.timed("distances", batches)
+
+        # Pass pairs if cached value is already there
+        missing_pairs = (
+            row
+            for batch in batches
+            for row in batch
+            if canonical_pair(row[0], row[1]) not in cached_pairs
+        )
+        if bulk:
+            store_bulk(conn, missing_pairs, batch_size)
+        else:
+            store_single(conn, missing_pairs)
+        save_max_id(conn, "distances", all_songs, features_version)
+    if use_replica:
+        replica.publish(conn, os.path.join(_BLISSIFY_DATA_HOME,
+                                           "replica.sqlite3"))
     # Close connection
     conn.close()
 
-
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", help="Engine used to compute distances.",
+                        choices=["numpy", "scalar"], default="numpy")
+    parser.add_argument("--tile-size",
+                        help="Number of songs per tile for the numpy engine.",
+                        type=int, default=_TILE_SIZE)
+    parser.add_argument("--verify",
+                        help="Check numpy results against the scalar engine.",
+                        action="store_true", default=False)
+    parser.add_argument("--bulk",
+                        help="Write distances by batches, through a staging table.",
+                        action="store_true", default=False)
+    parser.add_argument("--batch-size",
+                        help="Number of distances per transaction in bulk mode.",
+                        type=int, default=_BATCH_SIZE)
+    parser.add_argument("--journal-mode",
+                        help="SQLite journal mode to use (persistent for WAL).",
+                        choices=["DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL"])
+    parser.add_argument("--synchronous", help="SQLite synchronous mode to use.",
+                        choices=["OFF", "NORMAL", "FULL", "EXTRA"])
+    parser.add_argument("--workers",
+                        help="Number of worker processes (parallel mode, resumable).",
+                        type=int, default=0)
+    parser.add_argument("--block-size",
+                        help="Number of songs per row block in parallel mode.",
+                        type=int, default=_BLOCK_SIZE)
+    parser.add_argument("--top-k",
+                        help="Only store the K nearest neighbours of each song, in the neighbours table.",
+                        type=int, metavar="K")
+    parser.add_argument("--incremental",
+                        help="Only compute the distances and neighbours of the songs added or removed since the last build.",
+                        action="store_true", default=False)
+    parser.add_argument("--replica",
+                        help="Publish a read-only replica of the db for client.py --replica once the caches are built.",
+                        action="store_true", default=False)
+    parser.add_argument("--stats",
+                        help="Write a JSON summary of timers and counters to FILE ('-' for stderr) on exit.",
+                        metavar="FILE")
+    parser.add_argument("--profile",
+                        help="Dump cProfile stats of the run to FILE.",
+                        metavar="FILE")
+
+    args = parser.parse_args()
+    instrument.enable(args.stats, args.profile)
+
     try:
-        main()
+        main(args.engine, args.tile_size, args.verify, args.bulk,
+             args.batch_size, args.journal_mode, args.synchronous,
+             args.workers, args.block_size, args.top_k, args.incremental,
+             args.replica)
     except KeyboardInterrupt:
         pass
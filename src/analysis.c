@@ -39,6 +39,7 @@ int _init_db(char *data_folder, char* db_path)
         fprintf(stderr, "Unable to open SQLite db.\n");
         return 1;
     }
+    sqlite3_busy_timeout(dbh, BUSY_TIMEOUT);
     int dberr = sqlite3_exec(dbh, "PRAGMA foreign_keys = ON", NULL, NULL, NULL);
     if (SQLITE_OK != dberr) {
         fprintf(stderr, "Error creating db: %s.\n", sqlite3_errmsg(dbh));
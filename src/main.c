@@ -36,6 +36,7 @@ int main(int argc, char** argv) {
         fprintf(stderr, "Unable to open SQLite db.\n");
 		exit(EXIT_FAILURE);
     }
+    sqlite3_busy_timeout(dbh, BUSY_TIMEOUT);
     int dberr = sqlite3_exec(dbh, "PRAGMA foreign_keys = ON", NULL, NULL, NULL);
     if (SQLITE_OK != dberr) {
         fprintf(stderr, "Unable to open SQLite db.\n");
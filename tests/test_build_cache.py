@@ -0,0 +1,99 @@
+"""
+Tests of `scripts/build_cache.py`, run on synthetic dbs generated by
+`scripts/benchmark.py`.
+
+Run `python3 -m unittest discover tests` from the root of the repo.
+"""
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.path.join(_ROOT, "scripts"))
+import benchmark
+
+_BUILD_CACHE = os.path.join(_ROOT, "scripts", "build_cache.py")
+
+
+class BuildCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data_home = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.data_home.name, "blissify",
+                                    "db.sqlite3")
+        self.songs = benchmark.generate_songs(300)
+        benchmark.create_db(self.db_path, self.songs)
+
+    def tearDown(self):
+        self.data_home.cleanup()
+
+    def build_cache(self, *args):
+        subprocess.run(
+            [sys.executable, _BUILD_CACHE] + list(args),
+            env=dict(os.environ, XDG_DATA_HOME=self.data_home.name),
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def execute(self, query):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("PRAGMA foreign_keys=ON")
+        try:
+            with conn:
+                return conn.execute(query).fetchall()
+        finally:
+            conn.close()
+
+    def test_parallel_rebuild_after_distances_emptied(self):
+        nb_pairs = len(self.songs) * (len(self.songs) - 1) // 2
+        self.build_cache("--workers", "2", "--block-size", "100")
+        self.assertEqual(self.execute("SELECT COUNT(*) FROM distances"),
+                         [(nb_pairs,)])
+        self.assertEqual(
+            self.execute("SELECT value FROM metadata WHERE name='cache_checkpoint'"),
+            [])
+
+        self.execute("DELETE FROM distances")
+        self.build_cache("--workers", "2", "--block-size", "100")
+        self.assertEqual(self.execute("SELECT COUNT(*) FROM distances"),
+                         [(nb_pairs,)])
+
+    def test_song_at_mean(self):
+        # Songs symmetric around the origin, so that the means are exactly 0,
+        # and a song at the means
+        self.execute("DELETE FROM songs")
+        features = [benchmark.synthetic_features(song)
+                    for song, _ in self.songs[:50]]
+        rows = [vector for features_tuple in features
+                for vector in (features_tuple,
+                               tuple(-x for x in features_tuple))]
+        rows.append((0.0, 0.0, 0.0, 0.0))
+        conn = sqlite3.connect(self.db_path)
+        with conn:
+            conn.executemany(
+                "INSERT INTO songs(tempo, amplitude, frequency, attack, filename, album) VALUES(?, ?, ?, ?, ?, 'Album')",
+                (row + ("song%03d.flac" % (index,),)
+                 for index, row in enumerate(rows)))
+        conn.close()
+        at_mean = len(rows)
+
+        for args in (["--engine", "scalar"], ["--engine", "numpy", "--bulk"],
+                     ["--workers", "2"]):
+            self.execute("DELETE FROM distances")
+            self.build_cache(*args)
+            self.assertEqual(
+                self.execute("SELECT COUNT(*) FROM distances WHERE distance IS NULL OR similarity IS NULL"),
+                [(0,)])
+            self.assertEqual(
+                self.execute("SELECT DISTINCT similarity FROM distances WHERE song1=%d OR song2=%d" %
+                             (at_mean, at_mean)),
+                [(0.0,)])
+        for engine in ("scalar", "numpy"):
+            self.build_cache("--engine", engine, "--top-k", "5")
+            self.assertEqual(
+                self.execute("SELECT COUNT(*) FROM neighbours WHERE distance IS NULL OR similarity IS NULL"),
+                [(0,)])
+
+
+if __name__ == "__main__":
+    unittest.main()